@@ -19,4 +19,8 @@ users_collection = db.users
 companies_collection = db.companies
 products_collection = db.products
 images_collection = db.images
-app_configs_collection = db.app_configs  # Collection mới 
\ No newline at end of file
+app_configs_collection = db.app_configs  # Collection mới
+jobs_collection = db.jobs  # Hàng đợi job xử lý nền (tính hash ảnh, ...) 
+image_contents_collection = db.image_contents  # Cache descriptor theo SHA-256 nội dung ảnh
+image_urls_collection = db.image_urls  # Cache URL ảnh -> SHA-256 nội dung
+product_imports_collection = db.product_imports  # Thông tin các lần import sản phẩm hàng loạt
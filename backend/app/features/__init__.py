@@ -0,0 +1,21 @@
+"""Trích xuất đặc trưng ảnh dùng chung cho API tìm kiếm, job tính hash và các script.
+
+Mọi descriptor được tính theo một DescriptorSpec có version, version được lưu cùng ảnh
+(descriptor_version) để index không trộn descriptors của các spec khác nhau.
+"""
+from app.features.spec import (
+    DescriptorSpec,
+    DESCRIPTOR_SPECS,
+    FEATURE_VERSION,
+    LEGACY_DESCRIPTOR_VERSION,
+    company_descriptor_version,
+    get_spec,
+    image_descriptor_version,
+    image_hash_fields,
+    image_hash_for,
+    ingest_versions,
+)
+from app.features.orb import decode_image, extract_descriptors, get_orb_detector, read_jpeg_size
+
+# Spec của FEATURE_VERSION
+CURRENT_SPEC = get_spec(FEATURE_VERSION)
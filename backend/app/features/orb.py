@@ -0,0 +1,128 @@
+import logging
+import struct
+import threading
+import time
+from typing import Optional, Tuple
+import cv2
+import numpy as np
+from app.features.spec import DescriptorSpec
+from app.utils.timings import StageTimings
+
+logger = logging.getLogger(__name__)
+
+# Giải mã JPEG ở 1/8, 1/4, 1/2 độ phân giải (DCT scaling) khi ảnh vẫn đủ lớn so với kích thước cần
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+# Các marker SOF của JPEG (chứa kích thước ảnh)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# Mỗi thread giữ ORB detector của riêng mình (detectAndCompute không an toàn khi dùng chung giữa các thread)
+_local = threading.local()
+
+
+def get_orb_detector(num_features: int):
+    """ORB detector của thread hiện tại, chỉ tạo một lần cho mỗi thread và mỗi nfeatures"""
+    detectors = getattr(_local, "detectors", None)
+    if detectors is None:
+        detectors = _local.detectors = {}
+    orb = detectors.get(num_features)
+    if orb is None:
+        orb = detectors[num_features] = cv2.ORB_create(nfeatures=num_features)
+    return orb
+
+
+def read_jpeg_size(image_bytes: bytes) -> Optional[Tuple[int, int]]:
+    """Đọc (width, height) từ header JPEG mà không giải mã ảnh, None nếu không phải JPEG"""
+    if image_bytes[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 <= len(image_bytes):
+        if image_bytes[i] != 0xFF:
+            return None
+        marker = image_bytes[i + 1]
+        if marker == 0xFF:
+            # Byte đệm giữa các segment
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Marker không có độ dài
+            i += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", image_bytes[i + 5:i + 9])
+            return width, height
+        i += 2 + struct.unpack(">H", image_bytes[i + 2:i + 4])[0]
+    return None
+
+
+def decode_image(image_bytes: bytes, spec: DescriptorSpec, timings: Optional[StageTimings] = None) -> Optional[np.ndarray]:
+    """Giải mã và resize ảnh về spec.image_size x spec.image_size theo cách giải mã của spec.
+
+    "reduced_gray": ảnh JPEG lớn (ảnh chụp điện thoại) được giải mã ở độ phân giải giảm (chọn
+    theo kích thước trong header) thành ảnh xám, sau đó chỉ resize một lần.
+    """
+    started = time.perf_counter()
+    if spec.decode == "color":
+        flag, interpolation = cv2.IMREAD_COLOR, cv2.INTER_LINEAR
+    else:
+        flag, interpolation = cv2.IMREAD_GRAYSCALE, cv2.INTER_AREA
+        size = read_jpeg_size(image_bytes)
+        if size is not None:
+            for scale, reduced_flag in REDUCED_DECODE_FLAGS:
+                if min(size) // scale >= spec.image_size:
+                    flag = reduced_flag
+                    break
+
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+    decoded = time.perf_counter()
+    if timings is not None:
+        timings.record("decode", decoded - started)
+    if img is None:
+        return None
+
+    img = cv2.resize(img, (spec.image_size, spec.image_size), interpolation=interpolation)
+    if timings is not None:
+        timings.record("resize", time.perf_counter() - decoded)
+    return img
+
+
+def extract_descriptors(image_bytes: bytes, spec: DescriptorSpec, query: bool = False,
+                        timings: Optional[StageTimings] = None) -> Optional[np.ndarray]:
+    """Tính descriptors của ảnh theo spec, padding thành mảng (num_features, descriptor_size) uint8.
+
+    Trả về None nếu không giải mã được ảnh hoặc có ít descriptors hơn mức tối thiểu của spec
+    (min_query_descriptors với ảnh truy vấn, min_index_descriptors với ảnh lưu vào index).
+    """
+    try:
+        img = decode_image(image_bytes, spec, timings)
+        if img is None:
+            return None
+
+        started = time.perf_counter()
+        keypoints, descriptors = get_orb_detector(spec.num_features).detectAndCompute(img, None)
+        if timings is not None:
+            timings.record("orb", time.perf_counter() - started)
+
+        if descriptors is None or len(descriptors) == 0:
+            logger.warning("No ORB descriptors found in image")
+            return None
+
+        # Nếu số lượng features quá nhỏ, thì không đủ đặc trưng cho so sánh
+        min_descriptors = spec.min_query_descriptors if query else spec.min_index_descriptors
+        if len(descriptors) < min_descriptors:
+            logger.warning(f"Only {len(descriptors)} ORB descriptors found - not enough for matching")
+            return None
+
+        # Lấy num_features descriptors đầu tiên hoặc padding nếu thiếu
+        if len(descriptors) < spec.num_features:
+            padding = np.zeros((spec.num_features - len(descriptors), spec.descriptor_size), dtype=np.uint8)
+            descriptors = np.vstack([descriptors, padding])
+        else:
+            descriptors = descriptors[:spec.num_features]
+        return descriptors.astype(np.uint8)
+    except Exception as e:
+        logger.error(f"Error calculating ORB features: {str(e)}")
+        return None
@@ -0,0 +1,90 @@
+import os
+from typing import Dict, NamedTuple, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class DescriptorSpec(NamedTuple):
+    """Định dạng descriptor lưu trong image_hash: thuật toán, tham số và cách padding.
+
+    Descriptor của hai spec khác nhau không so sánh được với nhau, nên mỗi ảnh lưu kèm
+    descriptor_version và index của company chỉ chứa ảnh theo version của company
+    (companies.descriptor_version).
+    """
+    version: str
+    algorithm: str
+    num_features: int  # Số descriptor mỗi ảnh (nfeatures của ORB)
+    descriptor_size: int  # Số bytes mỗi descriptor
+    image_size: int  # Ảnh được resize về image_size x image_size trước khi tính
+    decode: str  # "color": giải mã đầy đủ, resize INTER_LINEAR; "reduced_gray": giải mã giảm độ phân giải, ảnh xám, resize INTER_AREA
+    padding: str  # "zeros": thêm các dòng 0 cho đủ num_features
+    min_index_descriptors: int  # Ảnh có ít descriptors hơn không được lưu vào index
+    min_query_descriptors: int  # Ảnh truy vấn có ít descriptors hơn không tìm kiếm được
+
+
+# Ảnh được tính trước khi có descriptor_version (không có trường này trong MongoDB)
+LEGACY_DESCRIPTOR_VERSION = "orb32-v1"
+
+DESCRIPTOR_SPECS: Dict[str, DescriptorSpec] = {
+    spec.version: spec
+    for spec in (
+        DescriptorSpec("orb32-v1", "orb", 32, 32, 256, "color", "zeros", 10, 1),
+        DescriptorSpec("orb32-v2", "orb", 32, 32, 256, "reduced_gray", "zeros", 10, 1),
+    )
+}
+
+# Version mục tiêu: company mới dùng ngay, company cũ chuyển sang khi update_data_hash.py đã tính xong mọi ảnh
+FEATURE_VERSION = os.getenv("FEATURE_VERSION", "orb32-v2")
+if FEATURE_VERSION not in DESCRIPTOR_SPECS:
+    raise ValueError(f"Unknown FEATURE_VERSION: {FEATURE_VERSION}")
+
+
+def get_spec(version: str) -> DescriptorSpec:
+    spec = DESCRIPTOR_SPECS.get(version)
+    if spec is None:
+        raise ValueError(f"Unknown descriptor version: {version}")
+    return spec
+
+
+def image_descriptor_version(image: Dict) -> str:
+    """Version descriptor của document ảnh trong images_collection"""
+    return image.get("descriptor_version") or LEGACY_DESCRIPTOR_VERSION
+
+
+def company_descriptor_version(company: Optional[Dict]) -> str:
+    """Version đang dùng cho index của company (company chưa chuyển version nào dùng version cũ)"""
+    return (company or {}).get("descriptor_version") or LEGACY_DESCRIPTOR_VERSION
+
+
+def ingest_versions(active_version: str) -> Tuple[str, ...]:
+    """Các version cần tính cho ảnh mới: version của index, cộng FEATURE_VERSION khi company đang chuyển sang"""
+    if active_version == FEATURE_VERSION:
+        return (active_version,)
+    return active_version, FEATURE_VERSION
+
+
+def image_hash_for(image: Dict, version: str) -> Optional[bytes]:
+    """Descriptor của ảnh theo version: image_hash, hoặc next_image_hash đã tính trước khi company chuyển version"""
+    if image.get("image_hash") and image_descriptor_version(image) == version:
+        return image["image_hash"]
+    if image.get("next_image_hash") and image.get("next_descriptor_version") == version:
+        return image["next_image_hash"]
+    return None
+
+
+def image_hash_fields(active_version: str, hashes: Dict[str, Optional[bytes]]) -> Dict:
+    """Các trường của document ảnh cho descriptors đã tính (version -> descriptor).
+
+    Descriptor theo version của index lưu vào image_hash; descriptor theo FEATURE_VERSION
+    (khi company chưa chuyển sang) lưu vào next_image_hash để chuyển version không cần tính lại
+    (None nếu ảnh không đủ đặc trưng theo FEATURE_VERSION).
+    """
+    fields = {}
+    if active_version in hashes:
+        fields["image_hash"] = hashes[active_version]
+        fields["descriptor_version"] = active_version
+    if active_version != FEATURE_VERSION and FEATURE_VERSION in hashes:
+        fields["next_image_hash"] = hashes[FEATURE_VERSION]
+        fields["next_descriptor_version"] = FEATURE_VERSION
+    return fields
@@ -10,6 +10,10 @@ from app.routers.user import user_router
 from app.routers.product import product_router
 from app.routers.app_config import app_config_router
 from app.routers.nhanhvn import nhanhvn_router
+from app.utils.image_search import search_index_registry
+from app.utils.image_processing import close_http_client
+from app.utils.job_queue import job_queue, JOB_WORKERS
+from app.utils.image_jobs import ensure_image_indexes  # Đăng ký handler cho các job xử lý ảnh
 import os
 
 app = FastAPI(title="Search Images API")
@@ -33,6 +37,33 @@ async def root():
 async def health_check():
     return {"status": "OK"}
 
+@app.on_event("startup")
+async def preload_search_indexes():
+    # Nạp index tìm kiếm đã lưu trên đĩa để không phải build lại từ MongoDB
+    try:
+        await search_index_registry.preload()
+    except Exception as e:
+        print(f"Error preloading search indexes: {str(e)}")
+
+@app.on_event("startup")
+async def start_job_workers():
+    # Worker xử lý hàng đợi job (tính hash ảnh), JOB_WORKERS=0 để chỉ chạy bằng run_job_worker.py
+    try:
+        await job_queue.ensure_indexes()
+    except Exception as e:
+        print(f"Error creating job queue indexes: {str(e)}")
+    try:
+        await ensure_image_indexes()
+    except Exception as e:
+        # Thường do dữ liệu cũ có ảnh trùng URL trong cùng sản phẩm
+        print(f"Error creating image indexes: {str(e)}")
+    job_queue.start(JOB_WORKERS)
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    await job_queue.stop()
+    await close_http_client()
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     print(f"Global error: {str(exc)}")
@@ -2,9 +2,12 @@ from fastapi import Request, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
 from datetime import datetime
+import hashlib
 import os
+import time
 from dotenv import load_dotenv
-from app.config.mongodb_config import users_collection
+from app.utils.cache import TTLCache
+from app.utils.user_cache import user_cache
 from bson.objectid import ObjectId
 
 # Load biến môi trường
@@ -14,47 +17,70 @@ load_dotenv()
 SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 ALGORITHM = "HS256"
 
+# Cache payload của các token đã xác thực (key là SHA-256 của token, hết hạn theo exp)
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "10000"))
+# Thời gian tối đa (giây) giữ một payload trong cache
+JWT_CACHE_MAX_TTL = float(os.getenv("JWT_CACHE_MAX_TTL", "3600"))
+token_cache = TTLCache("tokens", JWT_CACHE_SIZE, JWT_CACHE_MAX_TTL)
+
 # Tạo instance của HTTPBearer
 security = HTTPBearer()
 
-async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def _decode_token(token: str) -> dict:
+    """Giải mã và kiểm tra JWT, dùng cache theo hash của token cho tới khi token hết hạn"""
+    cache_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    payload = token_cache.get(cache_key)
+    if payload is not None:
+        return dict(payload)
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+    # Kiểm tra thời hạn token
+    exp = payload.get("exp")
+    if exp is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Token không hợp lệ"
+        )
+
+    if datetime.utcfromtimestamp(exp) < datetime.utcnow():
+        raise HTTPException(
+            status_code=401,
+            detail="Token đã hết hạn"
+        )
+
+    # Đảm bảo sub là string
+    if 'sub' in payload and isinstance(payload['sub'], ObjectId):
+        payload['sub'] = str(payload['sub'])
+
+    # Payload chỉ được dùng lại tới lúc token hết hạn
+    token_cache.set(cache_key, payload, ttl=min(exp - time.time(), JWT_CACHE_MAX_TTL))
+    return dict(payload)
+
+async def verify_token(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """
     Verify JWT token and return decoded payload
     """
+    # Token đã được xác thực trong cùng request (router và endpoint cùng khai báo Depends)
+    memoized = getattr(request.state, "token_payload", None)
+    if memoized is not None and memoized[0] == credentials.credentials:
+        return dict(memoized[1])
+
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        
-        # Kiểm tra thời hạn token
-        exp = payload.get("exp")
-        if exp is None:
-            raise HTTPException(
-                status_code=401,
-                detail="Token không hợp lệ"
-            )
-            
-        if datetime.utcfromtimestamp(exp) < datetime.utcnow():
-            raise HTTPException(
-                status_code=401,
-                detail="Token đã hết hạn"
-            )
-        
-        # Đảm bảo sub là string
-        if 'sub' in payload and isinstance(payload['sub'], ObjectId):
-            payload['sub'] = str(payload['sub'])
-            
-        return payload
-        
+        payload = _decode_token(credentials.credentials)
     except JWTError:
         raise HTTPException(
             status_code=401,
             detail="Token không hợp lệ"
         )
 
+    request.state.token_payload = (credentials.credentials, payload)
+    return dict(payload)
+
 async def verify_admin(token: str = Depends(verify_token)):
     try:
         # Lấy thông tin user từ token
-        user = await users_collection.find_one({"_id": ObjectId(token['sub'])})
+        user = await user_cache.get(token['sub'])
         if not user:
             raise HTTPException(
                 status_code=404,
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, validator
 from typing import Optional, List
 from datetime import datetime
 from .object_id import PyObjectId
@@ -15,6 +15,13 @@ class AppConfigCreate(BaseModel):
     product_names: Optional[List[str]] = None
     colors: Optional[List[str]] = None
     sizes: Optional[List[str]] = None
+    search_index_type: Optional[str] = None  # flat, ivf, hnsw hoặc auto
+
+    @validator('search_index_type')
+    def validate_search_index_type(cls, v):
+        if v is not None and v not in ("auto", "flat", "ivf", "hnsw"):
+            raise ValueError('search_index_type must be one of auto, flat, ivf, hnsw')
+        return v
 
 class AppConfigResponse(BaseModel):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
@@ -28,6 +35,7 @@ class AppConfigResponse(BaseModel):
     product_names: Optional[List[str]] = None
     colors: Optional[List[str]] = None
     sizes: Optional[List[str]] = None
+    search_index_type: Optional[str] = None
     created_at: datetime
     updated_at: datetime
 
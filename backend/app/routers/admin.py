@@ -1,19 +1,41 @@
 from fastapi import APIRouter, HTTPException, Depends
-from app.middleware.auth_middleware import verify_token, verify_admin
+from app.middleware.auth_middleware import verify_token, verify_admin, token_cache
 from app.config.mongodb_config import users_collection, companies_collection, products_collection
 from datetime import datetime
 from app.models.user import UserCreate, UserStatusUpdate, UserUpdate
 from app.utils.auth import get_password_hash
 from bson import ObjectId
+from app.utils.product_cache import product_cache
+from app.utils.user_cache import user_cache
+from app.utils.image_hash_cache import image_hash_cache
+from app.utils.query_cache import query_result_cache
+from app.utils.timings import query_timings
 
 admin_router = APIRouter()
 
+# Thống kê cache trong process (hit/miss) để theo dõi hiệu quả cache
+@admin_router.get("/cache-stats")
+async def get_cache_stats(current_user: dict = Depends(verify_admin)):
+    return {
+        "products": product_cache.stats(),
+        "product_summaries": product_cache.summary_stats(),
+        "users": user_cache.stats(),
+        "tokens": token_cache.stats(),
+        "image_hashes": image_hash_cache.stats(),
+        "search_results": query_result_cache.stats()
+    }
+
+@admin_router.get("/search-timings")
+async def get_search_timings(current_user: dict = Depends(verify_admin)):
+    """Thời gian trung bình / lâu nhất của từng bước xử lý ảnh truy vấn (decode, resize, orb, search)"""
+    return query_timings.stats()
+
 # Route quản lý người dùng (chỉ admin)
 @admin_router.get("/users")
 async def get_users(current_user: dict = Depends(verify_admin)):
     try:
         # Lấy thông tin user hiện tại
-        current_user_data = await users_collection.find_one({"_id": ObjectId(current_user['sub'])})
+        current_user_data = await user_cache.get(current_user['sub'])
         if not current_user_data:
             raise HTTPException(status_code=404, detail="Không tìm thấy thông tin người dùng")
             
@@ -78,6 +100,7 @@ async def delete_product(
         product_ref = products_collection.find_one({"_id": ObjectId(product_id)})
         if product_ref:
             result = products_collection.delete_one({"_id": ObjectId(product_id)})
+            product_cache.invalidate(product_id)
             if result.deleted_count > 0:
                 return {"message": "Xóa sản phẩm thành công"}
             else:
@@ -115,6 +138,7 @@ async def update_user_status(
                 }
             }
         )
+        user_cache.invalidate(user_id)
 
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Không thể cập nhật trạng thái")
@@ -151,6 +175,7 @@ async def update_user_role(
                 }
             }
         )
+        user_cache.invalidate(user_id)
 
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Không thể cập nhật vai trò")
@@ -172,7 +197,7 @@ async def create_user(user_data: UserCreate, current_user: dict = Depends(verify
             )
 
         # Lấy thông tin admin hiện tại
-        admin = await users_collection.find_one({"_id": ObjectId(current_user['sub'])})
+        admin = await user_cache.get(current_user['sub'])
         if not admin:
             raise HTTPException(
                 status_code=404, 
@@ -263,6 +288,7 @@ async def update_user(
             {"_id": ObjectId(user_id)},
             {"$set": update_data}
         )
+        user_cache.invalidate(user_id)
         
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Không thể cập nhật thông tin")
@@ -315,6 +341,7 @@ async def delete_user(
 
         # Thực hiện xóa
         result = await users_collection.delete_one({"_id": ObjectId(user_id)})
+        user_cache.invalidate(user_id)
         
         if result.deleted_count > 0:
             return {"message": "Xóa người dùng thành công"}
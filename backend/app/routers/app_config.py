@@ -2,6 +2,7 @@ from fastapi import APIRouter, HTTPException, Depends
 from app.middleware.auth_middleware import verify_token, verify_admin
 from app.config.mongodb_config import app_configs_collection, companies_collection, users_collection
 from app.models.app_config import AppConfigCreate, AppConfigResponse
+from app.utils.image_search import search_index_registry
 from datetime import datetime
 from bson import ObjectId
 from typing import List
@@ -37,6 +38,7 @@ async def create_app_config(
             "product_names": config_data.product_names or [],
             "colors": config_data.colors or [],
             "sizes": config_data.sizes or [],
+            "search_index_type": config_data.search_index_type,
             "created_at": now,
             "updated_at": now
         }
@@ -107,6 +109,7 @@ async def update_app_config(
             "product_names": config_data.product_names,
             "colors": config_data.colors,
             "sizes": config_data.sizes,
+            "search_index_type": config_data.search_index_type or config.get("search_index_type"),  # Cập nhật hoặc giữ nguyên
             "updated_at": datetime.utcnow()
         }
         
@@ -120,6 +123,10 @@ async def update_app_config(
             
         # Lấy cấu hình đã cập nhật
         updated_config = await app_configs_collection.find_one({"_id": ObjectId(config_id)})
+
+        # Đổi loại index tìm kiếm thì phải build lại index của company
+        if updated_config.get("search_index_type") != config.get("search_index_type"):
+            search_index_registry.invalidate(updated_config["company_id"])
         
         return {
             **updated_config,
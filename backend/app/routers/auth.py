@@ -5,6 +5,7 @@ from app.utils.auth import get_password_hash, verify_password, create_access_tok
 from datetime import datetime
 from app.config.mongodb_config import users_collection, companies_collection
 from app.utils.company_code import get_unique_company_code
+from app.features import FEATURE_VERSION
 from bson import ObjectId
 from pydantic import BaseModel
 
@@ -100,6 +101,8 @@ async def register(user_data: UserCreate):
             company_result = await companies_collection.insert_one({
                 'company_name': user_data.company_name,
                 'company_code': user_data.company_code,
+                # Company mới chưa có ảnh nên dùng ngay version descriptor hiện tại
+                'descriptor_version': FEATURE_VERSION,
                 'created_at': datetime.utcnow(),
                 'updated_at': datetime.utcnow()
             })
@@ -1,18 +1,17 @@
 from fastapi import APIRouter, HTTPException, Depends, Form, UploadFile, File
 from app.middleware.auth_middleware import verify_token
-from app.config.mongodb_config import users_collection, products_collection, images_collection
-from app.utils.image_search import ImageSearchEngine
+from app.utils.user_cache import user_cache
+from app.utils.image_search import search_index_registry
+from app.utils.product_cache import product_cache
+from app.utils.query_cache import query_result_cache
+from app.utils.search_pool import SearchPoolSaturated, SEARCH_BATCH_MAX_IMAGES
+from app.utils.index_factory import SEARCH_EFFORT_PRESETS, DEFAULT_SEARCH_EFFORT
 from typing import List
 import logging
-from pydantic import conint
-from bson import ObjectId
 
 logger = logging.getLogger(__name__)
 image_search_router = APIRouter()
 
-# Khởi tạo search engine
-search_engine = ImageSearchEngine()
-
 def normalize_percentage(value):
     """Chuẩn hóa giá trị về dạng phần trăm từ 0-100"""
     try:
@@ -21,81 +20,147 @@ def normalize_percentage(value):
     except:
         return 0
 
+def enrich_results(results, products, top_k):
+    """Gắn thông tin sản phẩm vào kết quả tìm kiếm, bỏ kết quả của sản phẩm không còn tồn tại"""
+    enriched_results = []
+    for result in results:
+        product = products.get(result['product_id'])
+        if product:
+            # similarity (0-100) đã được search engine tính theo chế độ so khớp
+            enriched_results.append({
+                **result,
+                'product_name': product.get('product_name', ''),
+                'product_code': product.get('product_code', ''),
+                'price': float(product.get('price', 0)),
+                'brand': product.get('brand', ''),
+                'description': product.get('description', '')
+            })
+    return enriched_results[:top_k]
+
+async def check_company_access(current_user: dict, company_id: str):
+    """Chỉ cho tìm kiếm trong company của user"""
+    user = await user_cache.get(current_user["sub"])
+    if not user:
+        raise HTTPException(status_code=404, detail="Không tìm thấy thông tin người dùng")
+
+    # Chuyển company_id sang ObjectId để so sánh
+    user_company_id = str(user.get('company_id'))
+    if user_company_id != company_id:
+        raise HTTPException(status_code=403, detail="Không có quyền truy cập")
+
 @image_search_router.post("/search")
 async def search_similar_images(
     file: UploadFile = File(..., description="Ảnh cần tìm kiếm"),
     company_id: str = Form(..., min_length=1),
     top_k: int = 6,
+    effort: str = DEFAULT_SEARCH_EFFORT,
     current_user: dict = Depends(verify_token)
 ):
     try:
+        # Mức đánh đổi recall/latency: fast, balanced, accurate
+        if effort not in SEARCH_EFFORT_PRESETS:
+            raise HTTPException(status_code=400, detail="Giá trị effort không hợp lệ")
+
         # Đọc file ảnh
         image_content = await file.read()
 
         # Kiểm tra quyền truy cập company
-        user = await users_collection.find_one({"_id": ObjectId(current_user["sub"])})
-        if not user:
-            raise HTTPException(status_code=404, detail="Không tìm thấy thông tin người dùng")
-            
-        # Chuyển company_id sang ObjectId để so sánh
-        user_company_id = str(user.get('company_id'))
-        if user_company_id != company_id:
-            raise HTTPException(status_code=403, detail="Không có quyền truy cập")
-
-        # Lấy tất cả ảnh của company có image_hash
-        images_cursor = images_collection.find({
-            "company_id": ObjectId(company_id),
-            "image_hash": {"$exists": True}
-        })
-        images_data = await images_cursor.to_list(None)
-
-        if not images_data:
+        await check_company_access(current_user, company_id)
+
+        # Lấy index của company từ cache (chỉ build lần đầu hoặc sau khi dữ liệu thay đổi)
+        search_engine = await search_index_registry.get_engine(company_id)
+
+        if len(search_engine) == 0:
             return {
                 "total": 0,
                 "results": [],
                 "message": "Không có ảnh để so sánh trong hệ thống"
             }
 
-        # Xây dựng index cho tìm kiếm
-        search_engine.build_index(images_data)
-        
-        # Tìm kiếm ảnh tương tự
-        results = search_engine.find_similar_images_from_bytes(image_content, int(top_k))
-
-        # Lấy thông tin sản phẩm cho mỗi kết quả
-        enriched_results = []
-        product_cache = {}
-
-        for result in results:
-            product_id = result['product_id']
-            
-            if product_id not in product_cache:
-                product = await products_collection.find_one({"_id": ObjectId(product_id)})
-                product_cache[product_id] = product
-            else:
-                product = product_cache[product_id]
-
-            if product:
-                # Tính độ tương đồng từ hamming_distance
-                # Giá trị hamming_distance càng thấp thì độ tương đồng càng cao
-                # Giả sử max hamming_distance là khoảng 1024 (32 features * 32 bytes * 8 bits)
-                similarity = max(0, 100 - (result['hamming_distance'] / 81.92))
-                
-                enriched_results.append({
-                    **result,
-                    'similarity': round(similarity, 10),  # round(similarity, 10) Đổi từ hamming_distance sang similarity percentage
-                    'product_name': product.get('product_name', ''),
-                    'product_code': product.get('product_code', ''),
-                    'price': float(product.get('price', 0)),
-                    'brand': product.get('brand', ''),
-                    'description': product.get('description', '')
-                })
+        # Tìm kiếm ảnh tương tự (tính ORB + FAISS trong thread pool để không chặn event loop),
+        # ảnh đã tìm với cùng phiên bản index thì lấy kết quả từ cache
+        results = (await query_result_cache.search(
+            search_engine, company_id, [image_content], int(top_k), effort
+        ))[0] or []
+
+        # Lấy thông tin sản phẩm của tất cả kết quả (từ cache, phần còn thiếu bằng một truy vấn)
+        products = await product_cache.get_summaries(result['product_id'] for result in results)
+
+        enriched_results = enrich_results(results, products, int(top_k))
 
         return {
             "total": len(enriched_results),
-            "results": enriched_results[:int(top_k)]
+            "results": enriched_results
         }
 
+    except SearchPoolSaturated:
+        raise HTTPException(
+            status_code=429,
+            detail="Hệ thống đang bận, vui lòng thử lại sau",
+            headers={"Retry-After": "1"}
+        )
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error in search_similar_images: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Lỗi tìm kiếm ảnh: {str(e)}") 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Lỗi tìm kiếm ảnh: {str(e)}")
+
+@image_search_router.post("/search/batch")
+async def search_similar_images_batch(
+    files: List[UploadFile] = File(..., description="Các ảnh cần tìm kiếm"),
+    company_id: str = Form(..., min_length=1),
+    top_k: int = 6,
+    effort: str = DEFAULT_SEARCH_EFFORT,
+    current_user: dict = Depends(verify_token)
+):
+    """Tìm kiếm nhiều ảnh trong một request: tính ORB song song, search FAISS một lần cho cả lô"""
+    try:
+        if effort not in SEARCH_EFFORT_PRESETS:
+            raise HTTPException(status_code=400, detail="Giá trị effort không hợp lệ")
+        if len(files) > SEARCH_BATCH_MAX_IMAGES:
+            raise HTTPException(status_code=400, detail=f"Tối đa {SEARCH_BATCH_MAX_IMAGES} ảnh mỗi request")
+
+        await check_company_access(current_user, company_id)
+
+        image_contents = [await file.read() for file in files]
+        search_engine = await search_index_registry.get_engine(company_id)
+
+        if len(search_engine) == 0:
+            return {
+                "total": len(files),
+                "results": [
+                    {"index": i, "filename": file.filename, "total": 0, "results": []}
+                    for i, file in enumerate(files)
+                ],
+                "message": "Không có ảnh để so sánh trong hệ thống"
+            }
+
+        # Tính ORB cho từng ảnh chưa có trong cache song song, sau đó search cả lô bằng một lần gọi FAISS
+        batch_results = await query_result_cache.search(search_engine, company_id, image_contents, int(top_k), effort)
+
+        # Lấy thông tin sản phẩm cho kết quả của tất cả ảnh bằng một lần truy vấn
+        products = await product_cache.get_summaries(
+            result['product_id'] for results in batch_results if results for result in results
+        )
+
+        response = []
+        for i, (file, results) in enumerate(zip(files, batch_results)):
+            enriched_results = enrich_results(results or [], products, int(top_k))
+            item = {"index": i, "filename": file.filename, "total": len(enriched_results), "results": enriched_results}
+            if results is None:
+                item["error"] = "Không tính được đặc trưng của ảnh"
+            response.append(item)
+
+        return {"total": len(response), "results": response}
+
+    except SearchPoolSaturated:
+        raise HTTPException(
+            status_code=429,
+            detail="Hệ thống đang bận, vui lòng thử lại sau",
+            headers={"Retry-After": "1"}
+        )
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error in search_similar_images_batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Lỗi tìm kiếm ảnh: {str(e)}")
@@ -1,13 +1,18 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 from typing import List
+from pydantic import ValidationError
 from app.models.product import ProductCreate, ProductUpdate, ProductResponse
 from app.middleware.auth_middleware import verify_token
-from app.config.mongodb_config import users_collection, products_collection, images_collection
+from app.config.mongodb_config import products_collection, images_collection, product_imports_collection
 from datetime import datetime
 from bson import ObjectId
-from app.utils.image_processing import process_image
+from app.utils.image_jobs import enqueue_image_hashing, HASH_PRODUCT_BATCH_JOB
+from app.utils.job_queue import job_queue
+from app.utils.image_search import search_index_registry
+from app.utils.product_cache import product_cache
+from app.utils.user_cache import user_cache
 import logging
-import asyncio
+import json
 import math
 from app.utils.permission import check_user_permission
 
@@ -16,6 +21,13 @@ logger = logging.getLogger(__name__)
 
 product_router = APIRouter()
 
+# Số sản phẩm mỗi lần insert_many khi import hàng loạt
+BULK_INSERT_BATCH_SIZE = 1000
+# Số sản phẩm trong mỗi job tính hash ảnh của một lần import
+BULK_HASH_JOB_SIZE = 50
+# Số lỗi tối đa trả về trong response import
+BULK_MAX_ERRORS = 100
+
 @product_router.post("/", response_model=ProductResponse)
 async def create_product(
     product_data: ProductCreate,
@@ -23,7 +35,7 @@ async def create_product(
 ):
     try:
         # Lấy thông tin user
-        user = await users_collection.find_one({"_id": ObjectId(current_user["sub"])})
+        user = await user_cache.get(current_user["sub"])
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
@@ -47,31 +59,10 @@ async def create_product(
         # Lưu sản phẩm
         result = await products_collection.insert_one(product_dict)
         product_id = str(result.inserted_id)
+        product_cache.put(product_dict)
         
-        # Tạo task xử lý ảnh bất đồng bộ
-        async def process_images():
-            try:
-                image_tasks = []
-                for url in product_data.image_urls:
-                    _, image_hash = process_image(url)
-                    if image_hash:
-                        image_tasks.append({
-                            "image_url": url,
-                            "company_id": ObjectId(product_data.company_id),
-                            "product_id": ObjectId(product_id),
-                            "uploaded_by": ObjectId(current_user["sub"]),
-                            "created_at": datetime.utcnow(),
-                            "image_hash": image_hash
-                        })
-
-                if image_tasks:
-                    await images_collection.insert_many(image_tasks)
-                    
-            except Exception as e:
-                logger.error(f"Error processing images: {str(e)}")
-
-        # Chạy xử lý ảnh bất đồng bộ
-        asyncio.create_task(process_images())
+        # Tải và tính hash ảnh trong hàng đợi job (xem trạng thái ở GET /{product_id}/jobs)
+        await enqueue_image_hashing(product_id, product_data.company_id, product_data.image_urls, current_user["sub"])
         
         # Trả về response
         return {
@@ -85,6 +76,188 @@ async def create_product(
         logger.error(f"Error in create_product: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def iter_bulk_products(request: Request):
+    """Đọc sản phẩm từ body: JSON (mảng hoặc {"products": [...]}) hoặc NDJSON (đọc dần từng dòng)"""
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        buffer = b""
+        line_number = 0
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                line_number += 1
+                if line.strip():
+                    yield line_number, line
+        if buffer.strip():
+            yield line_number + 1, buffer
+        return
+
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body không phải JSON hợp lệ")
+    items = body.get("products") if isinstance(body, dict) else body
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Body phải là mảng sản phẩm hoặc {\"products\": [...]}")
+    for index, item in enumerate(items, 1):
+        yield index, item
+
+@product_router.post("/bulk")
+async def bulk_create_products(
+    request: Request,
+    current_user: dict = Depends(verify_token)
+):
+    """Import hàng loạt sản phẩm, ảnh được tải và tính hash trong hàng đợi job"""
+    try:
+        user = await user_cache.get(current_user["sub"])
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+
+        import_id = ObjectId()
+        inserted = 0
+        jobs = 0
+        failed = 0
+        errors = []
+        allowed_companies = {}
+        company_ids = set()
+        pending = []
+
+        async def flush():
+            nonlocal inserted, jobs
+            if not pending:
+                return
+            # insert_many gán _id vào từng document
+            await products_collection.insert_many(pending, ordered=False)
+            inserted += len(pending)
+
+            # Gom sản phẩm có ảnh theo company thành các job tính hash
+            by_company = {}
+            for product in pending:
+                if product["image_urls"]:
+                    by_company.setdefault(product["company_id"], []).append({
+                        "product_id": str(product["_id"]),
+                        "image_urls": product["image_urls"]
+                    })
+            for company_id, items in by_company.items():
+                payloads = [
+                    {"products": items[i:i + BULK_HASH_JOB_SIZE], "uploaded_by": current_user["sub"]}
+                    for i in range(0, len(items), BULK_HASH_JOB_SIZE)
+                ]
+                jobs += await job_queue.enqueue_many(HASH_PRODUCT_BATCH_JOB, payloads, company_id=company_id, batch_id=import_id)
+            pending.clear()
+
+        async for position, item in iter_bulk_products(request):
+            try:
+                if isinstance(item, (bytes, str)):
+                    item = json.loads(item)
+                product_data = ProductCreate.parse_obj(item)
+                if not ObjectId.is_valid(product_data.company_id):
+                    raise ValueError("company_id không hợp lệ")
+
+                # Kiểm tra quyền một lần cho mỗi company (token không có company_id, dùng thông tin user)
+                if product_data.company_id not in allowed_companies:
+                    try:
+                        allowed_companies[product_data.company_id] = await check_user_permission(user, product_data.company_id)
+                    except HTTPException:
+                        allowed_companies[product_data.company_id] = False
+                if not allowed_companies[product_data.company_id]:
+                    raise ValueError("Không có quyền với company này")
+            except (ValueError, ValidationError) as e:
+                failed += 1
+                if len(errors) < BULK_MAX_ERRORS:
+                    errors.append({"index": position, "error": str(e)})
+                continue
+
+            company_ids.add(product_data.company_id)
+            now = datetime.utcnow()
+            pending.append({
+                "product_name": product_data.product_name,
+                "product_code": product_data.product_code,
+                "brand": product_data.brand or "",
+                "description": product_data.description or "",
+                "price": product_data.price,
+                "company_id": ObjectId(product_data.company_id),
+                "image_urls": list(dict.fromkeys(product_data.image_urls or [])),
+                "created_by": ObjectId(current_user["sub"]),
+                "created_by_name": user.get("username", "Unknown"),
+                "colors": product_data.colors or "",
+                "creator_name": product_data.creator_name or "",
+                "created_at": now,
+                "updated_at": now
+            })
+            if len(pending) >= BULK_INSERT_BATCH_SIZE:
+                await flush()
+
+        await flush()
+        # Lưu lại lần import để xem trạng thái cả khi không có job tính hash nào
+        await product_imports_collection.insert_one({
+            "_id": import_id,
+            "company_ids": sorted(company_ids),
+            "created_by": ObjectId(current_user["sub"]),
+            "inserted": inserted,
+            "failed": failed,
+            "jobs": jobs,
+            "created_at": datetime.utcnow()
+        })
+        logger.info(f"Bulk import {import_id}: {inserted} products, {jobs} hashing jobs, {failed} errors")
+
+        return {
+            "import_id": str(import_id),
+            "inserted": inserted,
+            "failed": failed,
+            "errors": errors,
+            "jobs": jobs
+        }
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error in bulk_create_products: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@product_router.get("/bulk/{import_id}")
+async def get_bulk_import_status(
+    import_id: str,
+    current_user: dict = Depends(verify_token)
+):
+    """Tiến độ tính hash ảnh của một lần import hàng loạt"""
+    try:
+        if not ObjectId.is_valid(import_id):
+            raise HTTPException(status_code=400, detail="import_id không hợp lệ")
+
+        bulk_import = await product_imports_collection.find_one({"_id": ObjectId(import_id)})
+        if not bulk_import:
+            raise HTTPException(status_code=404, detail="Không tìm thấy lần import")
+
+        # Kiểm tra quyền với mọi company trong lần import, lần import không có sản phẩm nào chỉ người tạo xem được
+        user = await user_cache.get(current_user["sub"])
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        for company_id in bulk_import["company_ids"]:
+            await check_user_permission(user, company_id)
+        if not bulk_import["company_ids"] and str(bulk_import["created_by"]) != current_user["sub"]:
+            raise HTTPException(status_code=403, detail="You don't have permission to perform this action")
+
+        # Lần import không có ảnh sẽ không có job nào, các bộ đếm đều bằng 0
+        status = await job_queue.get_batch_status(import_id)
+        counts = status["counts"]
+        return {
+            "import_id": import_id,
+            "inserted": bulk_import["inserted"],
+            "failed": bulk_import["failed"],
+            "jobs": status["total"],
+            "counts": counts,
+            "completed": counts["pending"] == 0 and counts["running"] == 0,
+            "errors": status["errors"]
+        }
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error getting bulk import status: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @product_router.get("/", response_model=dict)
 async def get_products(
     current_user: dict = Depends(verify_token),
@@ -100,7 +273,7 @@ async def get_products(
         cache_key = f"products_{current_user['sub']}_{page}_{limit}_{search}_{sort_by}_{sort_order}"
         
         # Lấy thông tin user
-        user = await users_collection.find_one({"_id": ObjectId(current_user["sub"])})
+        user = await user_cache.get(current_user["sub"])
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
@@ -216,9 +389,10 @@ async def update_product(
     current_user: dict = Depends(verify_token)
 ):
     try:
-        # Kiểm tra sản phẩm tồn tại
+        # Kiểm tra sản phẩm tồn tại (đọc thẳng MongoDB vì danh sách ảnh phải là mới nhất)
         product_doc = await products_collection.find_one({"_id": ObjectId(product_id)})
         if not product_doc:
+            product_cache.invalidate(product_id)
             raise HTTPException(status_code=404, detail="Product not found")
         
         # Kiểm tra quyền
@@ -234,29 +408,18 @@ async def update_product(
 
         # Xóa ảnh khỏi collection images
         if deleted_images:
-            await images_collection.delete_many({
-                "image_url": {"$in": list(deleted_images)},
-                "product_id": ObjectId(product_id)
-            })
-            logger.info(f"Deleted {len(deleted_images)} images from images collection")
+            deleted_docs = await images_collection.find(
+                {
+                    "image_url": {"$in": list(deleted_images)},
+                    "product_id": ObjectId(product_id)
+                },
+                {"_id": 1}
+            ).to_list(None)
+            deleted_image_ids = [doc["_id"] for doc in deleted_docs]
 
-        # Xử lý ảnh mới
-        for image_url in added_images:
-            try:
-                _, image_hash = process_image(image_url)
-                if image_hash is not None:
-                    await images_collection.insert_one({
-                        "image_url": image_url,
-                        "company_id": product_doc["company_id"],  # Giữ nguyên ObjectId
-                        "product_id": ObjectId(product_id),
-                        "uploaded_by": ObjectId(current_user["sub"]),
-                        "created_at": datetime.utcnow(),
-                        "image_hash": image_hash
-                    })
-                    logger.info(f"Added new image to images collection: {image_url}")
-            except Exception as e:
-                logger.error(f"Error processing image {image_url}: {str(e)}")
-                continue
+            await images_collection.delete_many({"_id": {"$in": deleted_image_ids}})
+            await search_index_registry.remove_images(product_doc["company_id"], deleted_image_ids)
+            logger.info(f"Deleted {len(deleted_image_ids)} images from images collection")
 
         # Cập nhật thông tin sản phẩm
         update_data = {
@@ -275,14 +438,19 @@ async def update_product(
             {"_id": ObjectId(product_id)},
             {"$set": update_data}
         )
+        product_cache.invalidate(product_id)
         
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Product update failed")
+
+        # Ảnh mới được tải và tính hash trong hàng đợi job sau khi image_urls đã được cập nhật
+        await enqueue_image_hashing(product_id, product_doc["company_id"], list(added_images), current_user["sub"])
             
         # Lấy sản phẩm đã cập nhật
         updated_product = await products_collection.find_one(
             {"_id": ObjectId(product_id)}
         )
+        product_cache.put(updated_product)
         return ProductResponse(**updated_product)
 
     except Exception as e:
@@ -296,7 +464,7 @@ async def delete_product(
 ):
     try:
         # Kiểm tra sản phẩm tồn tại
-        product = await products_collection.find_one({"_id": ObjectId(product_id)})
+        product = await product_cache.get(product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
             
@@ -304,13 +472,21 @@ async def delete_product(
         await check_user_permission(current_user, product["company_id"])
         
         # Xóa tất cả ảnh liên quan trong collection images
+        image_docs = await images_collection.find(
+            {"product_id": ObjectId(product_id)},
+            {"_id": 1}
+        ).to_list(None)
+        image_ids = [doc["_id"] for doc in image_docs]
+
         await images_collection.delete_many({
             "product_id": ObjectId(product_id)
         })
+        await search_index_registry.remove_images(product["company_id"], image_ids)
         logger.info(f"Deleted all images for product {product_id}")
         
         # Xóa sản phẩm
         result = await products_collection.delete_one({"_id": ObjectId(product_id)})
+        product_cache.invalidate(product_id)
         
         if result.deleted_count == 0:
             raise HTTPException(status_code=400, detail="Product deletion failed")
@@ -331,7 +507,7 @@ async def get_product_by_id(
 ):
     try:
         # Kiểm tra sản phẩm tồn tại
-        product = await products_collection.find_one({"_id": ObjectId(product_id)})
+        product = await product_cache.get(product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Không tìm thấy sản phẩm")
 
@@ -360,4 +536,42 @@ async def get_product_by_id(
 
     except Exception as e:
         logger.error(f"Error getting product details: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Lỗi lấy thông tin sản phẩm: {str(e)}") 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Lỗi lấy thông tin sản phẩm: {str(e)}") 
+@product_router.get("/{product_id}/jobs")
+async def get_product_jobs(
+    product_id: str,
+    current_user: dict = Depends(verify_token)
+):
+    try:
+        product = await product_cache.get(product_id)
+        if not product:
+            raise HTTPException(status_code=404, detail="Không tìm thấy sản phẩm")
+
+        # Kiểm tra quyền truy cập
+        await check_user_permission(current_user, product["company_id"])
+
+        jobs = await job_queue.get_jobs(product_id)
+        return {
+            "product_id": product_id,
+            "jobs": [
+                {
+                    "id": str(job["_id"]),
+                    "type": job["type"],
+                    "status": job["status"],
+                    "attempts": job["attempts"],
+                    "max_attempts": job["max_attempts"],
+                    "last_error": job.get("last_error"),
+                    "result": job.get("result"),
+                    "run_at": job["run_at"].isoformat() if isinstance(job.get("run_at"), datetime) else None,
+                    "created_at": job["created_at"].isoformat(),
+                    "updated_at": job["updated_at"].isoformat()
+                }
+                for job in jobs
+            ]
+        }
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error getting product jobs: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Lỗi lấy trạng thái xử lý ảnh: {str(e)}")
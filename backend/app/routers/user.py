@@ -5,6 +5,7 @@ from app.middleware.auth_middleware import verify_token
 from app.config.mongodb_config import users_collection, companies_collection
 from datetime import datetime
 from bson import ObjectId
+from app.utils.user_cache import user_cache
 
 user_router = APIRouter()
 
@@ -101,6 +102,7 @@ async def update_profile(
             {"_id": ObjectId(current_user['sub'])},
             {"$set": update_data}
         )
+        user_cache.invalidate(current_user['sub'])
         
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Không thể cập nhật thông tin")
@@ -0,0 +1,201 @@
+import heapq
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import faiss
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# File vocabulary đã train (tạo bằng train_vocabulary.py)
+VOCABULARY_PATH = os.getenv("VOCABULARY_PATH", "data/orb_vocabulary.npz")
+
+
+def _k_majority(descriptors: np.ndarray, bits: np.ndarray, k: int, iterations: int, rng) -> Tuple[np.ndarray, np.ndarray]:
+    """Phân cụm descriptors nhị phân bằng k-majority, trả về (centers, nhãn cụm)"""
+    centers = descriptors[rng.choice(len(descriptors), k, replace=False)].copy()
+    assignment = np.zeros(len(descriptors), dtype=np.int64)
+
+    for _ in range(iterations):
+        _, nearest = faiss.knn_hamming(descriptors, centers, 1)
+        assignment = nearest[:, 0]
+
+        # Center mới là bit chiếm đa số của các descriptor trong cụm
+        new_centers = centers.copy()
+        for c in range(k):
+            members = bits[assignment == c]
+            if len(members):
+                new_centers[c] = np.packbits(members.mean(axis=0) >= 0.5)
+
+        if np.array_equal(new_centers, centers):
+            break
+        centers = new_centers
+
+    return centers, assignment
+
+
+class BinaryVocabulary:
+    """Vocabulary tree cho ORB descriptors (256 bit), lá của cây là các visual word"""
+
+    def __init__(self, centers: np.ndarray, children: np.ndarray, words: np.ndarray, idf: np.ndarray):
+        self.centers = centers  # (num_nodes, 32) center của từng node, node 0 là gốc
+        self.children = children  # (num_nodes, branching) id node con, -1 nếu không có
+        self.words = words  # (num_nodes,) id word của node lá, -1 với node trong
+        self.idf = idf  # (num_words,) trọng số IDF của từng word
+
+    @property
+    def num_words(self) -> int:
+        return len(self.idf)
+
+    @classmethod
+    def train(
+        cls,
+        image_descriptors: List[np.ndarray],
+        branching: int = 10,
+        depth: int = 4,
+        iterations: int = 10,
+        seed: int = 0
+    ) -> "BinaryVocabulary":
+        """Train vocabulary từ danh sách descriptors của từng ảnh"""
+        rng = np.random.default_rng(seed)
+        descriptors = np.ascontiguousarray(np.vstack(image_descriptors), dtype=np.uint8)
+        bits = np.unpackbits(descriptors, axis=1)
+
+        centers = [np.zeros(descriptors.shape[1], dtype=np.uint8)]
+        children = [[-1] * branching]
+        levels = [0]
+
+        # Chia cụm theo từng tầng, mỗi phần tử là (node, chỉ số các descriptor thuộc node)
+        stack = [(0, np.arange(len(descriptors)))]
+        while stack:
+            node, members = stack.pop()
+            if levels[node] >= depth or len(members) <= branching:
+                continue
+
+            node_centers, assignment = _k_majority(
+                descriptors[members], bits[members], branching, iterations, rng
+            )
+            for c in range(branching):
+                child_members = members[assignment == c]
+                if len(child_members) == 0:
+                    continue
+                child = len(centers)
+                centers.append(node_centers[c])
+                children.append([-1] * branching)
+                levels.append(levels[node] + 1)
+                children[node][c] = child
+                stack.append((child, child_members))
+
+        children = np.array(children, dtype=np.int64)
+        is_leaf = np.all(children < 0, axis=1)
+        words = np.full(len(centers), -1, dtype=np.int64)
+        words[is_leaf] = np.arange(int(is_leaf.sum()))
+
+        vocabulary = cls(np.vstack(centers), children, words, np.zeros(int(is_leaf.sum()), dtype=np.float32))
+
+        # IDF = log(N / số ảnh chứa word)
+        document_frequency = np.zeros(vocabulary.num_words, dtype=np.float64)
+        for descriptors_of_image in image_descriptors:
+            document_frequency[np.unique(vocabulary.transform(descriptors_of_image))] += 1
+        num_images = len(image_descriptors)
+        vocabulary.idf = np.log(num_images / np.maximum(document_frequency, 1)).astype(np.float32)
+
+        logger.info(f"Trained vocabulary with {vocabulary.num_words} words from {len(descriptors)} descriptors")
+        return vocabulary
+
+    def transform(self, descriptors: np.ndarray) -> np.ndarray:
+        """Đổi mỗi descriptor thành id word bằng cách đi từ gốc xuống lá"""
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8)
+        nodes = np.zeros(len(descriptors), dtype=np.int64)
+
+        while True:
+            active = self.children[nodes, 0] >= 0
+            if not active.any():
+                break
+            for node in np.unique(nodes[active]):
+                selected = np.where(nodes == node)[0]
+                child_ids = self.children[node][self.children[node] >= 0]
+                _, nearest = faiss.knn_hamming(descriptors[selected], self.centers[child_ids], 1)
+                nodes[selected] = child_ids[nearest[:, 0]]
+
+        return self.words[nodes]
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.savez_compressed(path, centers=self.centers, children=self.children, words=self.words, idf=self.idf)
+
+    @classmethod
+    def load(cls, path: str) -> "BinaryVocabulary":
+        with np.load(path) as data:
+            return cls(data["centers"], data["children"], data["words"], data["idf"])
+
+
+_vocabulary: Optional[BinaryVocabulary] = None
+
+
+def get_vocabulary() -> Optional[BinaryVocabulary]:
+    """Đọc vocabulary từ VOCABULARY_PATH (chỉ đọc một lần), None nếu chưa train"""
+    global _vocabulary
+    if _vocabulary is None and os.path.exists(VOCABULARY_PATH):
+        _vocabulary = BinaryVocabulary.load(VOCABULARY_PATH)
+        logger.info(f"Loaded vocabulary with {_vocabulary.num_words} words from {VOCABULARY_PATH}")
+    return _vocabulary
+
+
+class InvertedFileIndex:
+    """Inverted index word -> ảnh, chấm điểm bằng cosine của vector TF-IDF"""
+
+    def __init__(self, vocabulary: BinaryVocabulary):
+        self.vocabulary = vocabulary
+        self.postings: Dict[int, Dict[int, float]] = {}  # word -> {id ảnh: trọng số}
+        self.doc_words: Dict[int, np.ndarray] = {}  # id ảnh -> các word của ảnh (để xóa)
+
+    @property
+    def ntotal(self) -> int:
+        return len(self.doc_words)
+
+    def _bow_vector(self, descriptors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Tính vector TF-IDF (đã chuẩn hóa L2) của một tập descriptors"""
+        words, counts = np.unique(self.vocabulary.transform(descriptors), return_counts=True)
+        weights = counts / counts.sum() * self.vocabulary.idf[words]
+        norm = np.linalg.norm(weights)
+        if norm == 0:
+            return words[:0], weights[:0]
+        return words, weights / norm
+
+    def add(self, doc_id: int, descriptors: np.ndarray) -> None:
+        words, weights = self._bow_vector(descriptors)
+        for word, weight in zip(words.tolist(), weights.tolist()):
+            self.postings.setdefault(word, {})[doc_id] = weight
+        self.doc_words[doc_id] = words
+
+    def remove(self, doc_id: int) -> None:
+        words = self.doc_words.pop(doc_id, None)
+        if words is None:
+            return
+        for word in words.tolist():
+            posting = self.postings.get(word)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[word]
+
+    def search(self, descriptors: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        """Trả về top_k (id ảnh, điểm cosine) chỉ duyệt posting list của các word trong truy vấn"""
+        words, weights = self._bow_vector(descriptors)
+        scores: Dict[int, float] = {}
+        for word, weight in zip(words.tolist(), weights.tolist()):
+            for doc_id, doc_weight in self.postings.get(word, {}).items():
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * doc_weight
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def copy(self) -> "InvertedFileIndex":
+        clone = InvertedFileIndex(self.vocabulary)
+        clone.postings = {word: dict(posting) for word, posting in self.postings.items()}
+        clone.doc_words = dict(self.doc_words)
+        return clone
@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from pymongo import UpdateOne
+from dotenv import load_dotenv
+from app.config.mongodb_config import image_contents_collection, image_urls_collection
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Số URL / nội dung ảnh giữ trong bộ nhớ của process và thời gian sống (giây)
+IMAGE_HASH_CACHE_SIZE = int(os.getenv("IMAGE_HASH_CACHE_SIZE", "50000"))
+IMAGE_HASH_CACHE_TTL = float(os.getenv("IMAGE_HASH_CACHE_TTL", "3600"))
+# Thời gian (giây) tin ánh xạ URL -> SHA-256, quá hạn thì tải lại ảnh vì nội dung ở URL có thể đã đổi
+IMAGE_URL_CACHE_TTL = float(os.getenv("IMAGE_URL_CACHE_TTL", "86400"))
+
+# (SHA-256 nội dung ảnh, descriptor; None nếu ảnh không đủ đặc trưng)
+CachedHash = Tuple[str, Optional[bytes]]
+
+
+def content_digest(image_bytes: bytes) -> str:
+    """SHA-256 (hex) của nội dung ảnh"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class ImageHashCache:
+    """Cache descriptor theo nội dung ảnh: URL -> SHA-256 nội dung -> descriptor của từng version.
+
+    Gồm hai tầng: LRU trong bộ nhớ và MongoDB (image_urls, image_contents) dùng chung giữa
+    các process. Ảnh có cùng nội dung chỉ tính ORB một lần, URL đã biết không cần tải lại
+    trong IMAGE_URL_CACHE_TTL giây kể từ lần tải gần nhất; tầng nội dung không hết hạn.
+    Lỗi MongoDB chỉ được ghi log, khi đó ảnh được tải và tính lại như bình thường.
+    Trong image_contents, descriptor của mỗi version lưu ở hashes.<descriptor_version>.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, url_ttl: float):
+        self._url_ttl = url_ttl
+        self._urls = TTLCache("image_urls", maxsize, min(ttl, url_ttl))  # url -> sha256
+        self._contents = TTLCache("image_contents", maxsize, ttl)  # (version, sha256) -> (descriptor,)
+
+    def get_local(self, url: str, version: str) -> Optional[CachedHash]:
+        """Tra URL trong bộ nhớ của process (không truy vấn MongoDB)"""
+        digest = self._urls.get(url)
+        return self.get_local_content(digest, version) if digest is not None else None
+
+    def get_local_content(self, digest: str, version: str) -> Optional[CachedHash]:
+        entry = self._contents.get((version, digest))
+        return (digest, entry[0]) if entry is not None else None
+
+    def set_local(self, url: Optional[str], digest: str, version: str, image_hash: Optional[bytes]) -> None:
+        if url is not None:
+            self._urls.set(url, digest)
+        self._contents.set((version, digest), (image_hash,))
+
+    async def get_contents(self, digests: Iterable[str], version: str) -> Dict[str, CachedHash]:
+        """Tra nhiều nội dung ảnh bằng một truy vấn $in, chỉ trả về nội dung có descriptor của version"""
+        results = {}
+        missing = []
+        for digest in set(digests):
+            cached = self.get_local_content(digest, version)
+            if cached is not None:
+                results[digest] = cached
+            else:
+                missing.append(digest)
+        if not missing:
+            return results
+
+        try:
+            contents = await self._find_contents(missing, version)
+        except Exception as e:
+            logger.warning(f"Image hash cache lookup failed: {str(e)}")
+            return results
+
+        for digest, image_hash in contents.items():
+            self.set_local(None, digest, version, image_hash)
+            results[digest] = (digest, image_hash)
+        return results
+
+    async def get_urls(self, urls: Iterable[str], version: str) -> Dict[str, CachedHash]:
+        """Tra nhiều URL cùng lúc (mỗi tầng MongoDB một truy vấn $in), chỉ trả về URL có descriptor của version"""
+        results = {}
+        missing = []
+        for url in urls:
+            cached = self.get_local(url, version)
+            if cached is not None:
+                results[url] = cached
+            else:
+                missing.append(url)
+        if not missing:
+            return results
+
+        try:
+            fresh_since = datetime.utcnow() - timedelta(seconds=self._url_ttl)
+            url_docs = await image_urls_collection.find(
+                {"_id": {"$in": missing}, "updated_at": {"$gte": fresh_since}}, {"sha256": 1}
+            ).to_list(None)
+            digests = {doc["_id"]: doc["sha256"] for doc in url_docs}
+            contents = await self._find_contents(list(set(digests.values())), version) if digests else {}
+        except Exception as e:
+            logger.warning(f"Image hash cache lookup failed: {str(e)}")
+            return results
+
+        for url, digest in digests.items():
+            if digest in contents:
+                self.set_local(url, digest, version, contents[digest])
+                results[url] = (digest, contents[digest])
+        return results
+
+    async def _find_contents(self, digests: List[str], version: str) -> Dict[str, Optional[bytes]]:
+        field = f"hashes.{version}"
+        docs = await image_contents_collection.find(
+            {"_id": {"$in": digests}, field: {"$exists": True}}, {field: 1}
+        ).to_list(None)
+        return {doc["_id"]: doc["hashes"][version] for doc in docs}
+
+    async def put_many(self, entries: Dict[str, CachedHash], version: str) -> None:
+        """Lưu kết quả url -> (sha256, descriptor theo version) vào cả hai tầng"""
+        if not entries:
+            return
+        now = datetime.utcnow()
+        content_ops = {}
+        url_ops = []
+        for url, (digest, image_hash) in entries.items():
+            self.set_local(url, digest, version, image_hash)
+            content_ops[digest] = UpdateOne(
+                {"_id": digest},
+                {"$set": {f"hashes.{version}": image_hash, "updated_at": now}},
+                upsert=True
+            )
+            url_ops.append(UpdateOne(
+                {"_id": url},
+                {"$set": {"sha256": digest, "updated_at": now}},
+                upsert=True
+            ))
+        try:
+            await image_contents_collection.bulk_write(list(content_ops.values()), ordered=False)
+            await image_urls_collection.bulk_write(url_ops, ordered=False)
+        except Exception as e:
+            logger.warning(f"Could not store {len(entries)} entries in image hash cache: {str(e)}")
+
+    def stats(self) -> Dict:
+        return {"urls": self._urls.stats(), "contents": self._contents.stats()}
+
+
+# Cache dùng chung cho toàn bộ ứng dụng
+image_hash_cache = ImageHashCache(IMAGE_HASH_CACHE_SIZE, IMAGE_HASH_CACHE_TTL, IMAGE_URL_CACHE_TTL)
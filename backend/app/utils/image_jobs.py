@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+from app.config.mongodb_config import images_collection, products_collection
+from app.features import image_hash_fields, ingest_versions
+from app.utils.image_processing import hash_image_urls
+from app.utils.image_search import search_index_registry
+from app.utils.job_queue import job_queue
+
+logger = logging.getLogger(__name__)
+
+HASH_IMAGES_JOB = "hash_images"
+# Job xử lý ảnh của nhiều sản phẩm (import hàng loạt), index chỉ cập nhật một lần mỗi job
+HASH_PRODUCT_BATCH_JOB = "hash_product_batch"
+# Số sản phẩm được tải/tính hash đồng thời trong một job batch
+BATCH_PRODUCT_CONCURRENCY = 8
+# Mã lỗi MongoDB khi vi phạm unique index
+DUPLICATE_KEY_ERROR = 11000
+
+
+async def ensure_image_indexes() -> None:
+    """Mỗi URL chỉ có một document ảnh trong một sản phẩm (job chạy trùng không tạo ảnh trùng)"""
+    await images_collection.create_index(
+        [("product_id", ASCENDING), ("image_url", ASCENDING)], unique=True
+    )
+
+
+async def enqueue_image_hashing(product_id, company_id, image_urls: List[str], uploaded_by) -> Optional[str]:
+    """Tạo job tải + tính hash các ảnh mới của sản phẩm, None nếu không có ảnh"""
+    if not image_urls:
+        return None
+    return await job_queue.enqueue(
+        HASH_IMAGES_JOB,
+        {"image_urls": list(image_urls), "uploaded_by": str(uploaded_by)},
+        product_id=product_id,
+        company_id=company_id
+    )
+
+
+async def _hash_product_images(product_id: ObjectId, company_id: ObjectId, image_urls: List[str],
+                               uploaded_by: ObjectId, descriptor_version: str) -> Tuple[List[Dict], List[str], int]:
+    """Tính hash các ảnh chưa được lưu của sản phẩm theo version descriptor của index.
+
+    Trả về (document ảnh mới, URL không tải được, số URL bỏ qua). Bỏ qua ảnh đã lưu và ảnh không
+    còn thuộc sản phẩm để job chạy lại (sau lỗi hoặc worker bị tắt) không tạo ảnh trùng. Ảnh tải
+    được nhưng không đủ đặc trưng cũng bị bỏ qua: thử lại vẫn cho cùng kết quả.
+    """
+    product = await products_collection.find_one({"_id": product_id}, {"image_urls": 1})
+    if not product:
+        return [], [], len(image_urls)
+
+    current_urls = set(product.get("image_urls", []))
+    existing = await images_collection.find(
+        {"product_id": product_id, "image_url": {"$in": image_urls}},
+        {"image_url": 1}
+    ).to_list(None)
+    done_urls = {image["image_url"] for image in existing}
+    urls = [url for url in image_urls if url in current_urls and url not in done_urls]
+
+    image_hashes = await hash_image_urls(urls, ingest_versions(descriptor_version))
+    image_docs = []
+    failed_urls = []
+    skipped = len(image_urls) - len(urls)
+    for url, hashes in image_hashes.items():
+        if hashes is None:
+            failed_urls.append(url)
+            continue
+        if hashes.get(descriptor_version) is None:
+            logger.warning(f"Skip image {url} of product {product_id}: not enough ORB features")
+            skipped += 1
+            continue
+        image_docs.append({
+            "image_url": url,
+            "company_id": company_id,
+            "product_id": product_id,
+            "uploaded_by": uploaded_by,
+            "created_at": datetime.utcnow(),
+            **image_hash_fields(descriptor_version, hashes)
+        })
+    return image_docs, failed_urls, skipped
+
+
+async def _save_images(company_id: ObjectId, image_docs: List[Dict], failed_urls: List[str]) -> None:
+    if image_docs:
+        # insert_many gán _id vào từng document, dùng luôn để cập nhật index
+        try:
+            await images_collection.insert_many(image_docs, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            # Ảnh đã được lưu bởi lần chạy khác của job, không thêm lại vào index
+            duplicates = {error["index"] for error in errors}
+            image_docs = [doc for i, doc in enumerate(image_docs) if i not in duplicates]
+        if image_docs:
+            await search_index_registry.add_images(company_id, image_docs)
+
+    if failed_urls:
+        # Lỗi tải ảnh để hàng đợi thử lại, các ảnh đã lưu sẽ được bỏ qua ở lần sau
+        raise RuntimeError(f"Could not download {len(failed_urls)} images: {', '.join(failed_urls[:5])}")
+
+
+async def process_hash_images_job(job: Dict) -> Dict:
+    """Tải, tính hash và lưu các ảnh mới của một sản phẩm"""
+    descriptor_version = await search_index_registry.get_descriptor_version(job["company_id"])
+    image_docs, failed_urls, skipped = await _hash_product_images(
+        job["product_id"], job["company_id"], job["payload"]["image_urls"], ObjectId(job["payload"]["uploaded_by"]),
+        descriptor_version
+    )
+    await _save_images(job["company_id"], image_docs, failed_urls)
+
+    logger.info(f"Hashed {len(image_docs)} images for product {job['product_id']}")
+    return {"added": len(image_docs), "skipped": skipped}
+
+
+async def process_hash_product_batch_job(job: Dict) -> Dict:
+    """Tải, tính hash ảnh của nhiều sản phẩm (cùng company) rồi lưu bằng một lần insert_many"""
+    uploaded_by = ObjectId(job["payload"]["uploaded_by"])
+    descriptor_version = await search_index_registry.get_descriptor_version(job["company_id"])
+    semaphore = asyncio.Semaphore(BATCH_PRODUCT_CONCURRENCY)
+
+    async def hash_product(item: Dict):
+        async with semaphore:
+            return await _hash_product_images(
+                ObjectId(item["product_id"]), job["company_id"], item["image_urls"], uploaded_by, descriptor_version
+            )
+
+    results = await asyncio.gather(*(hash_product(item) for item in job["payload"]["products"]))
+    image_docs = [doc for docs, _, _ in results for doc in docs]
+    failed_urls = [url for _, failed, _ in results for url in failed]
+    await _save_images(job["company_id"], image_docs, failed_urls)
+
+    logger.info(f"Hashed {len(image_docs)} images for {len(results)} products")
+    return {"added": len(image_docs), "skipped": sum(skipped for _, _, skipped in results)}
+
+
+job_queue.register(HASH_IMAGES_JOB, process_hash_images_job)
+job_queue.register(HASH_PRODUCT_BATCH_JOB, process_hash_product_batch_job)
@@ -1,84 +1,159 @@
-from PIL import Image
-import requests
-from io import BytesIO
+import httpx
+import asyncio
+import os
 from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
 import logging
-import cv2
-import numpy as np
-import faiss
+from dotenv import load_dotenv
+from app.utils.image_hash_cache import CachedHash, content_digest, image_hash_cache
+from app.features import FEATURE_VERSION, extract_descriptors, get_spec
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-executor = ThreadPoolExecutor(max_workers=3)  # Giới hạn số worker để tránh quá tải
+load_dotenv()
 
-def download_image(url):
-    """Tải ảnh với timeout và xử lý lỗi"""
+# Timeout (giây) khi tải một ảnh
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "10"))
+# Tổng số kết nối tải ảnh đồng thời và số kết nối tối đa tới cùng một host
+IMAGE_DOWNLOAD_MAX_CONNECTIONS = int(os.getenv("IMAGE_DOWNLOAD_MAX_CONNECTIONS", "32"))
+IMAGE_DOWNLOAD_PER_HOST = int(os.getenv("IMAGE_DOWNLOAD_PER_HOST", "4"))
+# Số thread tính ORB hash (OpenCV nhả GIL nên dùng thread là đủ)
+IMAGE_HASH_WORKERS = int(os.getenv("IMAGE_HASH_WORKERS", str(os.cpu_count() or 4)))
+
+executor = ThreadPoolExecutor(max_workers=IMAGE_HASH_WORKERS, thread_name_prefix="image-hash")
+
+_http_client: Optional[httpx.AsyncClient] = None
+_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+def calculate_orb_hash(image_bytes, version: str = FEATURE_VERSION):
+    """Tính ORB feature vector theo spec của version và mã hóa thành binary data để lưu vào database"""
+    descriptors = extract_descriptors(image_bytes, get_spec(version))
+    return descriptors.tobytes() if descriptors is not None else None
+
+def get_http_client() -> httpx.AsyncClient:
+    """HTTP client dùng chung (giữ kết nối) để tải ảnh"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=IMAGE_DOWNLOAD_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=IMAGE_DOWNLOAD_MAX_CONNECTIONS)
+        )
+    return _http_client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+def _host_semaphore(url: str) -> asyncio.Semaphore:
+    """Giới hạn số request đồng thời tới cùng một host"""
+    host = urlsplit(url).netloc
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = _host_semaphores.setdefault(host, asyncio.Semaphore(IMAGE_DOWNLOAD_PER_HOST))
+    return semaphore
+
+async def download_image_async(url: str) -> Optional[bytes]:
+    """Tải ảnh bất đồng bộ, không chặn event loop"""
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        return response.content
+        async with _host_semaphore(url):
+            response = await get_http_client().get(url)
+            response.raise_for_status()
+            return response.content
     except Exception as e:
         logger.error(f"Error downloading image from {url}: {str(e)}")
         return None
 
-def calculate_orb_hash(image_bytes):
-    """Tính ORB feature vector và mã hóa thành 64-bit hash"""
-    try:
-        # Chuyển bytes thành ảnh OpenCV
-        np_arr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        if img is None:
-            return None
-            
-        # Resize ảnh để đảm bảo tính nhất quán
-        img = cv2.resize(img, (256, 256))
-        
-        # Khởi tạo ORB detector với số lượng features giới hạn
-        orb = cv2.ORB_create(nfeatures=32)
-        
-        # Tính toán các keypoints và descriptors
-        keypoints, descriptors = orb.detectAndCompute(img, None)
-        
-        if descriptors is None or len(descriptors) == 0:
-            logger.warning("No ORB descriptors found in image")
-            return None
-            
-        # Nếu số lượng features quá nhỏ, thì không đủ đặc trưng cho so sánh
-        if len(descriptors) < 10:
-            logger.warning(f"Only {len(descriptors)} ORB descriptors found - not enough for matching")
-            return None
-            
-        # Lấy 32 descriptors đầu tiên hoặc padding nếu thiếu
-        if len(descriptors) < 32:
-            # Padding nếu có ít hơn 32 descriptors
-            padding = np.zeros((32 - len(descriptors), 32), dtype=np.uint8)
-            descriptors = np.vstack([descriptors, padding])
-        else:
-            # Lấy 32 descriptors
-            descriptors = descriptors[:32]
-            
-        # Chuyển đổi numpy array thành binary string để lưu vào database
-        binary_descriptors = descriptors.tobytes()
-        
-        return binary_descriptors
-    except Exception as e:
-        logger.error(f"Error calculating ORB hash: {str(e)}")
+class ConditionalFetch(NamedTuple):
+    """Kết quả tải ảnh có điều kiện: content là None khi server trả 304 (ảnh không đổi)"""
+    not_modified: bool
+    content: Optional[bytes]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_length: Optional[int]
+
+async def fetch_image_conditional(url: str, etag: Optional[str] = None,
+                                  last_modified: Optional[str] = None) -> ConditionalFetch:
+    """Tải ảnh với If-None-Match / If-Modified-Since, raise httpx.HTTPError nếu lỗi để bên gọi thử lại"""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    async with _host_semaphore(url):
+        response = await get_http_client().get(url, headers=headers)
+
+    if response.status_code == 304:
+        # Server có thể gửi lại validator mới cùng với 304
+        return ConditionalFetch(
+            True, None,
+            response.headers.get("etag", etag),
+            response.headers.get("last-modified", last_modified),
+            None
+        )
+    response.raise_for_status()
+    return ConditionalFetch(
+        False, response.content,
+        response.headers.get("etag"),
+        response.headers.get("last-modified"),
+        len(response.content)
+    )
+
+# Descriptor theo từng version (None nếu ảnh không đủ đặc trưng)
+ImageHashes = Dict[str, Optional[bytes]]
+
+async def download_and_hash(url: str, versions: Sequence[str]) -> Optional[Tuple[str, ImageHashes]]:
+    """Tải ảnh, trả về (sha256, descriptor của từng version), None nếu không tải được.
+
+    Chỉ tính ORB trong thread pool cho version chưa có trong cache của nội dung này.
+    """
+    image_bytes = await download_image_async(url)
+    if image_bytes is None:
         return None
+    digest = content_digest(image_bytes)
+    loop = asyncio.get_running_loop()
+    hashes = {}
+    for version in versions:
+        cached = (await image_hash_cache.get_contents([digest], version)).get(digest)
+        if cached is not None:
+            hashes[version] = cached[1]
+        else:
+            hashes[version] = await loop.run_in_executor(executor, calculate_orb_hash, image_bytes, version)
+    return digest, hashes
 
-def process_image(image_url):
-    """Xử lý ảnh và tính ORB feature hash"""
-    try:
-        # Tải ảnh
-        image_bytes = download_image(image_url)
-        if image_bytes is None:
-            return None, None
-            
-        # Tính ORB features hash
-        orb_hash = calculate_orb_hash(image_bytes)
-        
-        return None, orb_hash
-    except Exception as e:
-        logger.error(f"Error processing image {image_url}: {str(e)}")
-        return None, None 
\ No newline at end of file
+async def hash_image_urls(urls: List[str], versions: Sequence[str] = (FEATURE_VERSION,)) -> Dict[str, Optional[ImageHashes]]:
+    """Tải và tính ORB hash đồng thời cho nhiều ảnh, trả về dict url -> {version: hash}.
+
+    Giá trị None nghĩa là không tải được ảnh; hash None nghĩa là ảnh không đủ đặc trưng.
+    URL đã có trong cache (đủ mọi version) không được tải lại, kết quả mới được lưu vào cache.
+    """
+    urls = list(dict.fromkeys(urls))
+    results: Dict[str, Optional[ImageHashes]] = {url: {} for url in urls}
+    for version in versions:
+        for url, (_, image_hash) in (await image_hash_cache.get_urls(urls, version)).items():
+            results[url][version] = image_hash
+
+    missing = [url for url in urls if len(results[url]) < len(versions)]
+    if missing:
+        fetched = await asyncio.gather(*(
+            download_and_hash(url, [version for version in versions if version not in results[url]])
+            for url in missing
+        ))
+        new_entries: Dict[str, Dict[str, CachedHash]] = {version: {} for version in versions}
+        for url, result in zip(missing, fetched):
+            if result is None:
+                results[url] = None
+                continue
+            digest, hashes = result
+            results[url].update(hashes)
+            for version, image_hash in hashes.items():
+                new_entries[version][url] = (digest, image_hash)
+        for version, entries in new_entries.items():
+            await image_hash_cache.put_many(entries, version)
+    return results
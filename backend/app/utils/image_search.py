@@ -1,106 +1,464 @@
+import asyncio
 import logging
-from typing import List, Dict
+import os
+import time
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime
 import numpy as np
-import cv2
-import faiss
-from io import BytesIO
+from bson import ObjectId
+from pymongo import ReturnDocument
+from dotenv import load_dotenv
+from app.config.mongodb_config import images_collection, app_configs_collection, companies_collection
+from app.utils.bow_index import InvertedFileIndex, get_vocabulary
+from app.utils.index_factory import BinaryIndex, choose_index_type
+from app.utils import index_store, shared_index
+from app.utils.metadata_table import MetadataTable
+from app.features import (
+    FEATURE_VERSION, LEGACY_DESCRIPTOR_VERSION, company_descriptor_version, extract_descriptors, get_spec,
+    image_hash_for,
+)
+from app.utils.timings import query_timings
 
 logger = logging.getLogger(__name__)
 
+load_dotenv()
+
+# Mỗi ảnh lưu 32 ORB descriptors, mỗi descriptor 32 bytes (256 bit)
+NUM_DESCRIPTORS = 32
+DESCRIPTOR_SIZE = 32
+# 32 descriptors x 32 bytes x 8 bits
+DIMENSION = NUM_DESCRIPTORS * DESCRIPTOR_SIZE * 8
+
+# Chế độ so khớp:
+# - "local": index từng descriptor 256-bit, bỏ phiếu theo sản phẩm (chính xác hơn)
+# - "global": ghép 32 descriptors thành một vector 8192-bit (cách cũ)
+# - "bow": bag-of-words trên vocabulary đã train, inverted index + TF-IDF (cho catalog rất lớn)
+SEARCH_MATCH_MODE = os.getenv("SEARCH_MATCH_MODE", "local")
+# Lowe's ratio test: chỉ giữ match khi khoảng cách gần nhất < RATIO * khoảng cách của sản phẩm khác gần nhất
+LOCAL_MATCH_RATIO = 0.8
+# Số láng giềng lấy cho mỗi descriptor, để bỏ qua các ảnh khác của cùng sản phẩm khi làm ratio test
+LOCAL_NEIGHBOURS = 8
+# Khoảng cách Hamming tối đa (trên 256 bit) để một cặp descriptor được xem là khớp
+LOCAL_MAX_DISTANCE = 64
+# Tỉ lệ ảnh đã xóa nhưng còn nằm trong index (HNSW) để bắt buộc build lại
+MAX_TOMBSTONE_RATIO = 0.2
+# Số giây chờ trước khi ghi index xuống đĩa sau khi thay đổi (gộp nhiều thay đổi liên tiếp)
+SEARCH_INDEX_SAVE_DELAY = float(os.getenv("SEARCH_INDEX_SAVE_DELAY", "5"))
+# Số giây giữa hai lần kiểm tra search_index_version của company (ảnh được thêm bởi process khác, vd. run_job_worker.py)
+SEARCH_INDEX_REFRESH_INTERVAL = float(os.getenv("SEARCH_INDEX_REFRESH_INTERVAL", "5"))
+# Số lần thử attach index dùng chung khi bản vừa đọc bị thay bằng bản mới hơn
+SHARED_ATTACH_RETRIES = 3
+
+
+def resolve_match_mode(mode: Optional[str] = None) -> str:
+    """Chế độ so khớp thực tế (bow cần vocabulary, không có thì dùng local)"""
+    mode = mode or SEARCH_MATCH_MODE
+    if mode == "bow" and get_vocabulary() is None:
+        return "local"
+    return mode
+
 class ImageSearchEngine:
-    def __init__(self):
-        self.image_data = []  # Lưu thông tin về ảnh
-        self.faiss_index = None  # FAISS index
-        self.id_map = {}  # Ánh xạ từ index đến dữ liệu ảnh
+    """Index tìm kiếm ảnh của một company.
+
+    Engine đã được đưa vào SearchIndexRegistry thì coi như bất biến: mọi thay đổi
+    được áp dụng trên bản sao (copy) rồi thay thế, nên các request đang search
+    không cần lock.
+    """
+
+    def __init__(self, company_id: Optional[str] = None, mode: Optional[str] = None, index_type: Optional[str] = None,
+                 descriptor_version: Optional[str] = None):
+        self.company_id = str(company_id) if company_id else None
+        self.index_type = index_type  # Loại FAISS index mong muốn (None = theo cấu hình chung)
+        self.version: Optional[int] = None  # search_index_version của company tương ứng với dữ liệu trong index
+        # Version descriptor của mọi ảnh trong index, ảnh truy vấn được tính theo cùng spec
+        self.descriptor_version = descriptor_version or FEATURE_VERSION
+        if (mode or SEARCH_MATCH_MODE) not in ("local", "global", "bow"):
+            raise ValueError(f"Unknown search match mode: {mode or SEARCH_MATCH_MODE}")
+        self.mode = resolve_match_mode(mode)
+        if self.mode != (mode or SEARCH_MATCH_MODE):
+            logger.warning("Vocabulary not found, falling back to local matching mode")
+        self._reset()
+
+    def _reset(self) -> None:
+        """Khởi tạo index rỗng"""
+        self.faiss_index = None  # BinaryIndex (chế độ local/global), tạo khi thêm ảnh lần đầu
+        self.bow_index = None  # Inverted index (chế độ bow)
+        if self.mode == "bow":
+            self.bow_index = InvertedFileIndex(get_vocabulary())
+        self.metadata = MetadataTable(self.company_id)  # Metadata ảnh dạng cột, theo id trong FAISS
+        self._next_id = 0
+        self._tombstones = 0  # Số ảnh đã xóa nhưng index không hỗ trợ xóa (HNSW)
+        self._outgrown = False  # Loại index chọn theo số vector hiện tại khác loại đang dùng
+
+    @property
+    def dimension(self) -> int:
+        # Ở chế độ local, mỗi ảnh có nhiều dòng 256-bit trong index với cùng một id
+        return DESCRIPTOR_SIZE * 8 if self.mode == "local" else DIMENSION
+
+    @property
+    def needs_rebuild(self) -> bool:
+        """True khi index chứa quá nhiều ảnh đã xóa hoặc cần đổi loại index và nên được build lại"""
+        if self._outgrown:
+            return True
+        total = len(self.metadata) + self._tombstones
+        return self._tombstones > 0 and self._tombstones > MAX_TOMBSTONE_RATIO * total
+
+    def __len__(self) -> int:
+        return len(self.metadata)
+
+    def copy(self) -> "ImageSearchEngine":
+        """Tạo bản sao độc lập của engine (index FAISS và các bảng ánh xạ)"""
+        clone = ImageSearchEngine(self.company_id, self.mode, self.index_type, self.descriptor_version)
+        if self.bow_index is not None:
+            clone.bow_index = self.bow_index.copy()
+        elif self.faiss_index is not None:
+            clone.faiss_index = self.faiss_index.copy()
+        clone.metadata = self.metadata.copy()
+        clone._next_id = self._next_id
+        clone._tombstones = self._tombstones
+        clone._outgrown = self._outgrown
+        clone.version = self.version
+        return clone
+
+    def export_state(self):
+        """Trả về (FAISS index, thông tin engine, các mảng metadata) để lưu xuống đĩa (không hỗ trợ chế độ bow)"""
+        meta = {
+            "company_id": self.company_id,
+            "mode": self.mode,
+            "requested_index_type": self.index_type,
+            "index_type": self.faiss_index.index_type if self.faiss_index is not None else None,
+            "next_id": self._next_id,
+            "tombstones": self._tombstones,
+            "descriptor_version": self.descriptor_version
+        }
+        return (self.faiss_index.index if self.faiss_index is not None else None), meta, self.metadata.arrays()
+
+    @classmethod
+    def from_state(cls, index, meta: Dict, arrays: Dict[str, np.ndarray]) -> "ImageSearchEngine":
+        """Tạo engine từ dữ liệu đã lưu bằng export_state"""
+        engine = cls(
+            meta["company_id"], meta["mode"], meta["requested_index_type"],
+            meta.get("descriptor_version", LEGACY_DESCRIPTOR_VERSION)
+        )
+        if index is not None:
+            engine.faiss_index = BinaryIndex(index, meta["index_type"])
+        engine._next_id = meta["next_id"]
+        engine._tombstones = meta["tombstones"]
+        engine.version = meta["version"]
+        engine.metadata = MetadataTable(meta["company_id"], arrays)
+        return engine
 
     def calculate_orb_from_bytes(self, image_bytes: bytes):
-        """Tính ORB features từ bytes của ảnh"""
+        """Tính ORB features từ bytes của ảnh theo spec của index"""
+        return extract_descriptors(image_bytes, get_spec(self.descriptor_version), query=True, timings=query_timings)
+
+    def _parse_descriptors(self, binary_data: bytes) -> Optional[np.ndarray]:
+        """Chuyển image_hash từ DB thành các vector nhị phân để đưa vào index"""
         try:
-            # Chuyển bytes thành ảnh OpenCV
-            np_arr = np.frombuffer(image_bytes, np.uint8)
-            img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-            if img is None:
-                return None
-                
-            # Resize ảnh để đảm bảo tính nhất quán
-            img = cv2.resize(img, (256, 256))
-            
-            # Khởi tạo ORB detector
-            orb = cv2.ORB_create(nfeatures=32)
-            
-            # Tính toán các keypoints và descriptors
-            keypoints, descriptors = orb.detectAndCompute(img, None)
-            
-            if descriptors is None or len(descriptors) == 0:
-                logger.warning("No ORB descriptors found in image")
-                return None
-                
-            # Đảm bảo có đủ 32 descriptors
-            if len(descriptors) < 32:
-                # Padding nếu có ít hơn 32 descriptors
-                padding = np.zeros((32 - len(descriptors), 32), dtype=np.uint8)
-                descriptors = np.vstack([descriptors, padding])
-            else:
-                # Lấy 32 descriptors
-                descriptors = descriptors[:32]
-                
-            return descriptors.astype(np.uint8)
+            descriptors = np.frombuffer(binary_data, dtype=np.uint8).reshape(NUM_DESCRIPTORS, DESCRIPTOR_SIZE)
         except Exception as e:
-            logger.error(f"Error calculating ORB features from bytes: {str(e)}")
+            logger.error(f"Error parsing image hash: {str(e)}")
             return None
 
+        if self.mode in ("local", "bow"):
+            # Bỏ các dòng padding toàn 0
+            descriptors = descriptors[np.any(descriptors != 0, axis=1)]
+            return descriptors if len(descriptors) else None
+        return descriptors.reshape(1, DIMENSION // 8)
+
+    def collect_vectors(self, images_data: List[Dict]) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """Gán id cho các ảnh mới, trả về (vectors, id của từng dòng) để đưa vào index"""
+        vectors = []
+        row_ids = []
+        new_faiss_ids = []
+        new_images = []
+
+        known = self.metadata.contains([img_data['_id'] for img_data in images_data])
+        seen = set()
+        other_versions = 0
+        for img_data, is_known in zip(images_data, known):
+            image_id = str(img_data.get('_id'))
+            if is_known or image_id in seen:
+                continue
+
+            # Không cho ảnh của company khác lọt vào index
+            if self.company_id and str(img_data.get('company_id')) != self.company_id:
+                logger.warning(f"Skip image {image_id}: not owned by company {self.company_id}")
+                continue
+
+            # Descriptors của spec khác không so sánh được với các ảnh trong index
+            binary_data = image_hash_for(img_data, self.descriptor_version)
+            if binary_data is None:
+                # Ảnh không có hash (không đủ đặc trưng) thì không tính là khác version
+                if img_data.get("image_hash"):
+                    other_versions += 1
+                continue
+
+            vector = self._parse_descriptors(binary_data)
+            if vector is None:
+                continue
+
+            faiss_id = self._next_id
+            self._next_id += 1
+            seen.add(image_id)
+            new_faiss_ids.append(faiss_id)
+            new_images.append(img_data)
+            vectors.append(vector)
+            row_ids.append(np.full(len(vector), faiss_id, dtype=np.int64))
+
+        if other_versions:
+            logger.warning(
+                f"Skipped {other_versions} images of company {self.company_id} with descriptor version other than "
+                f"{self.descriptor_version}, run update_data_hash.py to rehash them"
+            )
+
+        # Chỉ giữ metadata cần cho kết quả, không giữ document (và image_hash) trong bộ nhớ
+        self.metadata.append(new_faiss_ids, new_images)
+        if not vectors:
+            return None, None
+        return np.vstack(vectors), np.concatenate(row_ids)
+
+    def add_images(self, images_data: List[Dict]) -> int:
+        """Thêm ảnh vào index hiện có, trả về số ảnh đã thêm"""
+        count_before = len(self.metadata)
+        vectors, row_ids = self.collect_vectors(images_data)
+        if vectors is None:
+            return 0
+
+        if self.bow_index is not None:
+            # Các dòng của cùng một ảnh nằm liền nhau
+            splits = np.flatnonzero(np.diff(row_ids)) + 1
+            for image_vectors, image_row_ids in zip(np.split(vectors, splits), np.split(row_ids, splits)):
+                self.bow_index.add(int(image_row_ids[0]), image_vectors)
+        else:
+            if self.faiss_index is None:
+                # Index được tạo (và train nếu là IVF) từ lô ảnh đầu tiên
+                index_type = choose_index_type(len(vectors), self.index_type)
+                self.faiss_index = BinaryIndex.create(self.dimension, index_type, vectors)
+                logger.info(f"Created {self.faiss_index.index_type} index for company {self.company_id}")
+            else:
+                # Loại index được chọn lại theo số vector sau khi thêm, khác loại hiện tại thì build lại
+                index_type = choose_index_type(self.faiss_index.ntotal + len(vectors), self.index_type)
+                if index_type != self.faiss_index.index_type:
+                    logger.info(
+                        f"Search index of company {self.company_id} should change from "
+                        f"{self.faiss_index.index_type} to {index_type}, scheduling rebuild"
+                    )
+                    self._outgrown = True
+            self.faiss_index.add_with_ids(vectors, row_ids)
+        return len(self.metadata) - count_before
+
+    def remove_images(self, image_ids: List) -> int:
+        """Xóa ảnh khỏi index theo _id của ảnh, trả về số ảnh đã xóa"""
+        faiss_ids = self.metadata.remove(image_ids)
+
+        if self.bow_index is not None:
+            for faiss_id in faiss_ids.tolist():
+                self.bow_index.remove(faiss_id)
+        elif len(faiss_ids) and self.faiss_index is not None:
+            if self.faiss_index.supports_remove:
+                # remove_ids xóa mọi dòng có cùng id (tất cả descriptors của ảnh)
+                self.faiss_index.remove_ids(faiss_ids)
+            else:
+                # Ảnh đã bỏ khỏi metadata nên sẽ bị bỏ qua khi đọc kết quả
+                self._tombstones += len(faiss_ids)
+        return len(faiss_ids)
+
     def build_index(self, images_data: List[Dict]) -> None:
         """Xây dựng FAISS index từ dữ liệu ảnh"""
         try:
+            self._reset()
             if not images_data:
                 return
 
-            valid_images = []
-            descriptors_list = []
-            
-            # Tạo danh sách các ảnh có hash hợp lệ
-            for i, img_data in enumerate(images_data):
-                if 'image_hash' in img_data and img_data['image_hash']:
-                    try:
-                        # Chuyển binary_string từ DB thành numpy array
-                        binary_data = img_data['image_hash']
-                        descriptors = np.frombuffer(binary_data, dtype=np.uint8).reshape(32, 32)
-                        
-                        descriptors_list.append(descriptors)
-                        valid_images.append(img_data)
-                        self.id_map[len(valid_images)-1] = img_data
-                    except Exception as e:
-                        logger.error(f"Error parsing image hash: {str(e)}")
-                        continue
-
-            self.image_data = valid_images
-            
-            if not descriptors_list:
+            if self.add_images(images_data) == 0:
                 logger.warning("No valid descriptor data found for building index")
-                return
-                
-            # Ghép tất cả descriptors thành một ma trận lớn
-            all_descriptors = np.vstack(descriptors_list)
-            
-            # Tạo FAISS binary index
-            dimension = 32 * 32 * 8  # 32 descriptors x 32 bytes x 8 bits
-            self.faiss_index = faiss.IndexBinaryFlat(dimension)
-            
-            # Đưa dữ liệu vào index
-            binary_data = all_descriptors.reshape(-1, dimension // 8)
-            self.faiss_index.add(binary_data)
 
         except Exception as e:
             logger.error(f"Error building FAISS index: {str(e)}")
             raise
 
+    def _format_result(self, img: Dict, hamming_distance: Optional[float], similarity: float) -> Dict:
+        return {
+            'product_id': str(img['product_id']),
+            'image_url': img['image_url'],
+            'hamming_distance': float(hamming_distance) if hamming_distance is not None else None,  # Khoảng cách hamming
+            'similarity': round(similarity, 10),  # Độ tương đồng 0-100
+            'company_id': str(img['company_id']),
+            'created_at': img['created_at'].isoformat() if isinstance(img['created_at'], datetime) else img['created_at']
+        }
+
+    def _search_global(self, queries: List[np.ndarray], top_k: int, effort: Optional[str] = None) -> List[List[Dict]]:
+        """So khớp cả vector 8192-bit của các ảnh truy vấn với từng ảnh trong index (một lần search)"""
+        # Chuẩn bị dữ liệu truy vấn cho FAISS binary index: mỗi ảnh một dòng
+        query_binary = np.vstack([query.reshape(1, DIMENSION // 8) for query in queries])
+
+        # Thực hiện tìm kiếm top_k ảnh gần nhất
+        k = min(top_k + self._tombstones, self.faiss_index.ntotal)
+        distances, indices = self.faiss_index.search(query_binary, k, effort)
+
+        batch_results = []
+        for row_distances, row_indices in zip(distances, indices):
+            results = []
+            positions = self.metadata.positions_of(row_indices)
+            for distance, position in zip(row_distances, positions):
+                if position < 0:
+                    continue
+                img = self.metadata.row(int(position))
+
+                # Hamming distance trong FAISS là số bit khác nhau, càng thấp càng giống nhau
+                # Tối đa 8192 bit => chia 81.92 để đổi sang phần trăm
+                similarity = max(0, 100 - (float(distance) / 81.92))
+                results.append(self._format_result(img, distance, similarity))
+
+            # Sắp xếp theo khoảng cách tăng dần (gần nhất lên đầu)
+            results.sort(key=lambda x: x['hamming_distance'])
+            batch_results.append(results[:top_k])
+        return batch_results
+
+    def _search_local(self, queries: List[np.ndarray], top_k: int, effort: Optional[str] = None) -> List[List[Dict]]:
+        """So khớp từng descriptor của các ảnh truy vấn (một lần search) rồi bỏ phiếu theo sản phẩm"""
+        queries = [query[np.any(query != 0, axis=1)] for query in queries]
+        counts = [len(query) for query in queries]
+        if not sum(counts):
+            return [[] for _ in queries]
+
+        # Lấy nhiều láng giềng cho mỗi descriptor để tìm được láng giềng thuộc sản phẩm khác (ratio test)
+        k = min(LOCAL_NEIGHBOURS, self.faiss_index.ntotal)
+        distances, indices = self.faiss_index.search(np.vstack(queries), k, effort)
+
+        # Tách kết quả theo từng ảnh truy vấn
+        batch_results = []
+        offset = 0
+        for count in counts:
+            batch_results.append(
+                self._vote_local(distances[offset:offset + count], indices[offset:offset + count], k, top_k)
+                if count else []
+            )
+            offset += count
+        return batch_results
+
+    def _vote_local(self, distances: np.ndarray, indices: np.ndarray, k: int, top_k: int) -> List[Dict]:
+        """Bỏ phiếu theo sản phẩm từ kết quả search các descriptor của một ảnh truy vấn"""
+        # faiss id -> (vị trí dòng, product_id) của mọi láng giềng, ảnh đã xóa không có trong map
+        neighbour_ids = np.unique(indices[indices >= 0])
+        rows = {
+            int(faiss_id): (int(position), self.metadata.product_key(int(position)))
+            for faiss_id, position in zip(neighbour_ids, self.metadata.positions_of(neighbour_ids))
+            if position >= 0
+        }
+
+        # faiss id của ảnh -> [số descriptor khớp, tổng khoảng cách]
+        votes: Dict[int, List[float]] = {}
+        for row_distances, row_indices in zip(distances, indices):
+            best_id = int(row_indices[0])
+            best_distance = float(row_distances[0])
+            if best_id not in rows or best_distance > LOCAL_MAX_DISTANCE:
+                continue
+
+            # Ratio test: bỏ match mơ hồ khi láng giềng gần nhất thuộc sản phẩm khác cũng gần tương đương.
+            # Các ảnh khác của cùng sản phẩm (ảnh trùng, nhiều góc chụp) không làm match mơ hồ
+            best_product = rows[best_id][1]
+            for distance, faiss_id in zip(row_distances[1:k], row_indices[1:k]):
+                runner_up = rows.get(int(faiss_id))
+                if runner_up is not None and runner_up[1] != best_product:
+                    ambiguous = best_distance >= LOCAL_MATCH_RATIO * float(distance)
+                    break
+            else:
+                ambiguous = False
+            if ambiguous:
+                continue
+
+            vote = votes.setdefault(best_id, [0, 0.0])
+            vote[0] += 1
+            vote[1] += best_distance
+
+        # Gom theo sản phẩm, giữ ảnh có nhiều phiếu nhất làm đại diện
+        best_by_product: Dict[bytes, tuple] = {}
+        for faiss_id, (matches, total_distance) in votes.items():
+            position, product_key = rows[faiss_id]
+            avg_distance = total_distance / matches
+            current = best_by_product.get(product_key)
+            if current is None or (matches, -avg_distance) > (current[1], -current[2]):
+                best_by_product[product_key] = (int(position), matches, avg_distance)
+
+        ranked = sorted(best_by_product.values(), key=lambda item: (-item[1], item[2]))
+        results = []
+        for position, matches, avg_distance in ranked[:top_k]:
+            # Chỉ tạo metadata đầy đủ cho các kết quả trả về
+            img = self.metadata.row(position)
+            similarity = min(100, matches / len(distances) * 100)
+            result = self._format_result(img, avg_distance, similarity)
+            result['match_count'] = matches
+            results.append(result)
+        return results
+
+    def _search_bow(self, query_descriptors: np.ndarray, top_k: int) -> List[Dict]:
+        """Tìm ảnh có vector bag-of-words gần nhất, mỗi sản phẩm lấy ảnh điểm cao nhất"""
+        query = query_descriptors[np.any(query_descriptors != 0, axis=1)]
+        if len(query) == 0:
+            return []
+
+        # Lấy dư ứng viên vì nhiều ảnh có thể thuộc cùng một sản phẩm
+        candidates = self.bow_index.search(query, top_k * 4)
+
+        results = []
+        seen_products = set()
+        positions = self.metadata.positions_of([faiss_id for faiss_id, _ in candidates])
+        for (faiss_id, score), position in zip(candidates, positions):
+            if position < 0:
+                continue
+            product_key = self.metadata.product_key(int(position))
+            if product_key in seen_products:
+                continue
+            seen_products.add(product_key)
+            results.append(self._format_result(self.metadata.row(int(position)), None, min(100, score * 100)))
+            if len(results) >= top_k:
+                break
+        return results
+
+    def search_descriptors(
+        self,
+        queries: List[Optional[np.ndarray]],
+        top_k: int = 5,
+        effort: Optional[str] = None
+    ) -> List[List[Dict]]:
+        """Tìm ảnh tương tự cho nhiều ảnh truy vấn (descriptors đã tính) bằng một lần search FAISS.
+
+        Ảnh truy vấn không tính được descriptors (None) có kết quả rỗng.
+        """
+        results = [[] for _ in queries]
+        valid = [i for i, query in enumerate(queries) if query is not None]
+        if not valid:
+            return results
+
+        if not len(self.metadata):
+            logger.warning("No image data or FAISS index available")
+            return results
+
+        valid_queries = [queries[i] for i in valid]
+        with query_timings.measure("search"):
+            if self.mode == "bow":
+                batch_results = [self._search_bow(query, top_k) for query in valid_queries]
+            elif self.mode == "local":
+                batch_results = self._search_local(valid_queries, top_k, effort)
+            else:
+                batch_results = self._search_global(valid_queries, top_k, effort)
+
+        for i, query_results in zip(valid, batch_results):
+            results[i] = query_results
+        return results
+
     def find_similar_images_from_bytes(
         self, 
         image_bytes: bytes, 
-        top_k: int = 5
+        top_k: int = 5,
+        effort: Optional[str] = None
     ) -> List[Dict]:
-        """Tìm ảnh tương tự dựa trên ORB features và FAISS"""
+        """Tìm ảnh tương tự dựa trên ORB features và FAISS
+
+        effort ("fast", "balanced", "accurate") đánh đổi recall/latency với index IVF/HNSW.
+        """
         try:
             # Tính ORB features cho ảnh truy vấn
             query_descriptors = self.calculate_orb_from_bytes(image_bytes)
@@ -109,39 +467,384 @@ class ImageSearchEngine:
                 logger.warning("Could not calculate ORB features for query image")
                 return []
 
-            if not self.image_data or self.faiss_index is None:
-                logger.warning("No image data or FAISS index available")
-                return []
+            return self.search_descriptors([query_descriptors], top_k, effort)[0]
 
-            # Chuẩn bị dữ liệu truy vấn cho FAISS binary index
-            dimension = 32 * 32 * 8  # 32 descriptors x 32 bytes x 8 bits
-            query_binary = query_descriptors.reshape(1, dimension // 8)
-            
-            # Thực hiện tìm kiếm top_k ảnh gần nhất
-            distances, indices = self.faiss_index.search(query_binary, min(top_k, len(self.image_data)))
-            
-            # Lấy kết quả
-            results = []
-            for i, (distance, idx) in enumerate(zip(distances[0], indices[0])):
-                if idx < 0 or idx >= len(self.image_data):
+        except Exception as e:
+            logger.error(f"Error searching similar images: {str(e)}")
+            return []
+
+class SearchIndexRegistry:
+    """Lưu FAISS index của từng company trong bộ nhớ, chỉ build lại khi bị invalidate.
+
+    Đọc (get_engine) không cần lock: chỉ lấy engine hiện tại trong dict. Ghi (build,
+    thêm/xóa ảnh) được tuần tự hóa theo từng company và luôn thay engine mới vào dict.
+    Index được lưu xuống đĩa kèm search_index_version của company, khi khởi động chỉ
+    đọc lại từ đĩa nếu phiên bản vẫn khớp với MongoDB.
+    """
+
+    def __init__(self):
+        self._engines: Dict[str, ImageSearchEngine] = {}  # company_id -> engine đã build
+        self._locks: Dict[str, asyncio.Lock] = {}  # Tuần tự hóa việc ghi theo từng company
+        self._generations: Dict[str, int] = {}  # Tăng mỗi lần invalidate để bỏ kết quả build cũ
+        self._pending_saves = set()  # Các company đang chờ ghi index xuống đĩa
+        self._checked_at: Dict[str, float] = {}  # Thời điểm kiểm tra phiên bản gần nhất
+
+    def _is_fresh(self, company_id: str) -> bool:
+        checked_at = self._checked_at.get(company_id)
+        return checked_at is not None and time.monotonic() - checked_at < SEARCH_INDEX_REFRESH_INTERVAL
+
+    def _get_lock(self, company_id: str) -> asyncio.Lock:
+        lock = self._locks.get(company_id)
+        if lock is None:
+            lock = self._locks.setdefault(company_id, asyncio.Lock())
+        return lock
+
+    async def get_descriptor_version(self, company_id) -> str:
+        """Version descriptor dùng cho index của company (ảnh mới được tính theo version này)"""
+        company = await companies_collection.find_one(
+            {"_id": ObjectId(company_id)},
+            {"descriptor_version": 1}
+        )
+        return company_descriptor_version(company)
+
+    async def _get_version(self, company_id: str) -> int:
+        """Phiên bản dữ liệu ảnh hiện tại của company trong MongoDB"""
+        company = await companies_collection.find_one(
+            {"_id": ObjectId(company_id)},
+            {"search_index_version": 1}
+        )
+        return company.get("search_index_version", 0) if company else 0
+
+    async def _bump_version(self, company_id: str) -> int:
+        """Tăng phiên bản dữ liệu ảnh của company, trả về phiên bản mới"""
+        company = await companies_collection.find_one_and_update(
+            {"_id": ObjectId(company_id)},
+            {"$inc": {"search_index_version": 1}},
+            projection={"search_index_version": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        return company.get("search_index_version", 0) if company else 0
+
+    async def _get_index_type(self, company_id: str) -> Optional[str]:
+        """Loại index riêng của company (nếu được cấu hình trong app_configs)"""
+        app_config = await app_configs_collection.find_one(
+            {"company_id": ObjectId(company_id)},
+            {"search_index_type": 1}
+        )
+        return app_config.get("search_index_type") if app_config else None
+
+    def _load_engine(self, company_id: str, version: int, index_type: Optional[str]) -> Optional[ImageSearchEngine]:
+        """Đọc engine đã lưu trên đĩa nếu khớp phiên bản và cấu hình hiện tại"""
+        try:
+            loaded = index_store.load_index(company_id, version)
+            if loaded is None:
+                return None
+            index, meta, arrays = loaded
+            if meta.get("mode") != resolve_match_mode() or meta.get("requested_index_type") != index_type:
+                return None
+            return ImageSearchEngine.from_state(index, meta, arrays)
+        except Exception as e:
+            logger.error(f"Error loading saved search index of company {company_id}: {str(e)}")
+            return None
+
+    async def _load_images(self, company_id: str) -> List[Dict]:
+        """Đọc toàn bộ ảnh có image_hash của company từ MongoDB"""
+        images_cursor = images_collection.find(
+            {
+                "company_id": ObjectId(company_id),
+                "image_hash": {"$exists": True}
+            },
+            {
+                "image_hash": 1, "image_url": 1, "product_id": 1, "company_id": 1, "created_at": 1,
+                "descriptor_version": 1, "next_image_hash": 1, "next_descriptor_version": 1
+            }
+        )
+        return await images_cursor.to_list(None)
+
+    async def _build_engine(self, company_id: str, index_type: Optional[str]) -> ImageSearchEngine:
+        """Đọc toàn bộ image_hash của company từ MongoDB và build index"""
+        descriptor_version = await self.get_descriptor_version(company_id)
+        images_data = await self._load_images(company_id)
+
+        engine = ImageSearchEngine(company_id, index_type=index_type, descriptor_version=descriptor_version)
+        await asyncio.to_thread(engine.build_index, images_data)
+        logger.info(f"Built search index for company {company_id}: {len(engine)} images")
+        return engine
+
+    async def get_engine(self, company_id: str) -> ImageSearchEngine:
+        """Lấy engine của company từ cache, đọc từ đĩa hoặc build nếu chưa có.
+
+        Engine trong cache được kiểm tra lại search_index_version mỗi SEARCH_INDEX_REFRESH_INTERVAL
+        giây và build lại nếu process khác đã thay đổi ảnh của company.
+        """
+        company_id = str(company_id)
+        engine = self._engines.get(company_id)
+        if engine is not None and self._is_fresh(company_id):
+            return engine
+
+        async with self._get_lock(company_id):
+            engine = self._engines.get(company_id)
+            if engine is not None and self._is_fresh(company_id):
+                return engine
+
+            generation = self._generations.get(company_id, 0)
+            # Đọc phiên bản trước dữ liệu: nếu ảnh thay đổi trong lúc build, phiên bản lưu sẽ cũ và bị build lại
+            version = await self._get_version(company_id)
+            # Các request khác tiếp tục dùng engine cũ trong lúc build lại
+            self._checked_at[company_id] = time.monotonic()
+            if engine is not None and engine.version == version:
+                return engine
+
+            index_type = await self._get_index_type(company_id)
+
+            engine = await asyncio.to_thread(self._load_engine, company_id, version, index_type)
+            loaded_from_disk = engine is not None
+            if engine is None:
+                engine = await self._build_engine(company_id, index_type)
+                engine.version = version
+
+            # Chỉ lưu cache nếu dữ liệu không bị thay đổi trong lúc build
+            if self._generations.get(company_id, 0) == generation:
+                self._engines[company_id] = engine
+                self._checked_at[company_id] = time.monotonic()
+                if not loaded_from_disk:
+                    self._schedule_save(company_id)
+            return engine
+
+    async def preload(self) -> None:
+        """Nạp các index đã lưu trên đĩa còn đúng phiên bản (gọi khi khởi động)"""
+        loaded = 0
+        for company_id in index_store.list_company_ids():
+            if not ObjectId.is_valid(company_id):
+                continue
+            async with self._get_lock(company_id):
+                if company_id in self._engines:
                     continue
-                    
-                img = self.id_map[idx]
-                
-                # Hamming distance trong FAISS là số bit khác nhau
-                # Giá trị càng thấp càng giống nhau
-                results.append({
-                    'product_id': str(img['product_id']),
-                    'image_url': img['image_url'],
-                    'hamming_distance': float(distance),  # Khoảng cách hamming
-                    'company_id': str(img['company_id']),
-                    'created_at': img['created_at'].isoformat() if isinstance(img['created_at'], datetime) else img['created_at']
-                })
+                version = await self._get_version(company_id)
+                index_type = await self._get_index_type(company_id)
+                engine = await asyncio.to_thread(self._load_engine, company_id, version, index_type)
+                if engine is not None:
+                    self._engines[company_id] = engine
+                    loaded += 1
+        logger.info(f"Preloaded {loaded} search indexes from disk")
 
-            # Sắp xếp theo khoảng cách tăng dần (gần nhất lên đầu)
-            results.sort(key=lambda x: x['hamming_distance'])
-            return results[:top_k]
+    def _schedule_save(self, company_id: str) -> None:
+        """Hẹn ghi index của company xuống đĩa, gộp các thay đổi liên tiếp thành một lần ghi"""
+        if company_id in self._pending_saves:
+            return
+        self._pending_saves.add(company_id)
+        asyncio.create_task(self._save_later(company_id))
 
+    async def _save_later(self, company_id: str) -> None:
+        await asyncio.sleep(SEARCH_INDEX_SAVE_DELAY)
+        self._pending_saves.discard(company_id)
+
+        engine = self._engines.get(company_id)
+        if engine is None or engine.mode == "bow" or engine.version is None:
+            return
+        try:
+            index, meta, arrays = engine.export_state()
+            await asyncio.to_thread(index_store.save_index, company_id, engine.version, index, meta, arrays)
         except Exception as e:
-            logger.error(f"Error searching similar images: {str(e)}")
-            return [] 
\ No newline at end of file
+            logger.error(f"Error saving search index of company {company_id}: {str(e)}")
+
+    async def _apply_delta(self, company_id: str, version: int, apply) -> Optional[int]:
+        """Áp dụng thay đổi lên bản sao của engine hiện tại rồi thay thế (copy-on-write)"""
+        async with self._get_lock(company_id):
+            engine = self._engines.get(company_id)
+            if engine is None:
+                # Chưa có index trong cache, lần search sau sẽ đọc/build theo phiên bản mới
+                return None
+            if engine.version != version - 1:
+                # Engine đã bỏ lỡ thay đổi của process khác, build lại ở lần search sau
+                self.invalidate(company_id)
+                return None
+
+            generation = self._generations.get(company_id, 0)
+
+            def copy_and_apply():
+                new_engine = engine.copy()
+                return new_engine, apply(new_engine)
+
+            new_engine, changed = await asyncio.to_thread(copy_and_apply)
+            new_engine.version = version
+
+            if new_engine.needs_rebuild:
+                # Quá nhiều ảnh đã xóa còn trong index (HNSW) hoặc cần đổi loại index, build lại ở lần search sau
+                self.invalidate(company_id)
+            elif self._generations.get(company_id, 0) == generation:
+                self._engines[company_id] = new_engine
+                self._schedule_save(company_id)
+            return changed
+
+    async def add_images(self, company_id, images_data: List[Dict]) -> None:
+        """Thêm ảnh mới vào index đang cache của company"""
+        company_id = str(company_id)
+        version = await self._bump_version(company_id)
+        added = await self._apply_delta(company_id, version, lambda engine: engine.add_images(images_data))
+        if added is not None:
+            logger.info(f"Added {added} images to search index of company {company_id}")
+
+    async def remove_images(self, company_id, image_ids: List) -> None:
+        """Xóa ảnh khỏi index đang cache của company"""
+        company_id = str(company_id)
+        version = await self._bump_version(company_id)
+        removed = await self._apply_delta(company_id, version, lambda engine: engine.remove_images(image_ids))
+        if removed is not None:
+            logger.info(f"Removed {removed} images from search index of company {company_id}")
+
+    def invalidate(self, company_id) -> None:
+        """Xóa index của company khỏi cache, lần search sau sẽ build lại"""
+        company_id = str(company_id)
+        self._generations[company_id] = self._generations.get(company_id, 0) + 1
+        self._engines.pop(company_id, None)
+        logger.info(f"Invalidated search index for company {company_id}")
+
+
+class SharedSearchIndexRegistry(SearchIndexRegistry):
+    """Registry khi chạy nhiều worker: index của mỗi company được publish ra file dùng chung.
+
+    Worker giữ khóa file của company build index từ MongoDB rồi publish ma trận codes
+    và bảng metadata dạng cột, mọi worker chỉ mmap read-only nên không giữ bản sao riêng.
+    Index chia sẻ luôn tìm kiếm brute-force (không dùng IVF/HNSW, bỏ qua effort).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._seqs: Dict[str, int] = {}  # company_id -> seq của bản publish đang attach
+
+    def _is_fresh(self, company_id: str) -> bool:
+        checked_at = self._checked_at.get(company_id)
+        return checked_at is not None and time.monotonic() - checked_at < shared_index.SEARCH_SHARED_REFRESH_INTERVAL
+
+    def _is_current(self, info: Optional[Dict], version: int) -> bool:
+        return info is not None and info["mode"] == resolve_match_mode() and info["data_version"] >= version
+
+    def _attach_engine(self, company_id: str, info: Dict) -> Tuple[ImageSearchEngine, Dict]:
+        """Tạo engine read-only trên bản index đã publish, trả về (engine, thông tin bản đã attach).
+
+        Worker khác có thể publish bản mới và xóa bản info["seq"] trước khi kịp attach,
+        khi đó đọc lại current.json và attach bản mới nhất.
+        """
+        for _ in range(SHARED_ATTACH_RETRIES):
+            engine = ImageSearchEngine(
+                company_id, info["mode"], descriptor_version=info.get("descriptor_version", LEGACY_DESCRIPTOR_VERSION)
+            )
+            try:
+                engine.faiss_index, engine.metadata = shared_index.attach(company_id, info)
+            except FileNotFoundError:
+                latest = shared_index.read_current(company_id)
+                if latest is None or latest["seq"] == info["seq"]:
+                    raise
+                info = latest
+                continue
+            engine.version = info["data_version"]
+            return engine, info
+        raise RuntimeError(f"Shared search index of company {company_id} kept changing while attaching")
+
+    def _publish_full(self, company_id: str, version: int, images_data: List[Dict], descriptor_version: str) -> Dict:
+        """Build codes + metadata từ dữ liệu MongoDB và publish (gọi khi đang giữ khóa)"""
+        engine = ImageSearchEngine(company_id, descriptor_version=descriptor_version)
+        vectors, row_ids = engine.collect_vectors(images_data)
+        if vectors is None:
+            vectors = np.zeros((0, engine.dimension // 8), dtype=np.uint8)
+            row_ids = np.zeros(0, dtype=np.int64)
+        info = shared_index.publish(
+            company_id, vectors, row_ids, engine.metadata.arrays(),
+            version, engine.mode, engine._next_id, engine.descriptor_version
+        )
+        logger.info(f"Built shared search index for company {company_id}: {len(engine)} images")
+        return info
+
+    async def _publish_if_stale(self, company_id: str, version: int) -> Dict:
+        """Build và publish index nếu bản đang publish cũ hơn version"""
+        lock_file = await asyncio.to_thread(shared_index.acquire_lock, company_id)
+        try:
+            # Worker khác có thể đã publish trong lúc chờ khóa
+            info = shared_index.read_current(company_id)
+            if self._is_current(info, version):
+                return info
+            descriptor_version = await self.get_descriptor_version(company_id)
+            images_data = await self._load_images(company_id)
+            return await asyncio.to_thread(self._publish_full, company_id, version, images_data, descriptor_version)
+        finally:
+            shared_index.release_lock(lock_file)
+
+    async def get_engine(self, company_id: str) -> ImageSearchEngine:
+        """Attach bản index đã publish, build và publish nếu chưa có hoặc đã cũ"""
+        company_id = str(company_id)
+        engine = self._engines.get(company_id)
+        if engine is not None and self._is_fresh(company_id):
+            return engine
+
+        async with self._get_lock(company_id):
+            engine = self._engines.get(company_id)
+            if engine is not None and self._is_fresh(company_id):
+                return engine
+
+            version = await self._get_version(company_id)
+            info = shared_index.read_current(company_id)
+            if not self._is_current(info, version):
+                info = await self._publish_if_stale(company_id, version)
+
+            if engine is None or self._seqs.get(company_id) != info["seq"]:
+                engine, info = await asyncio.to_thread(self._attach_engine, company_id, info)
+                self._engines[company_id] = engine
+                self._seqs[company_id] = info["seq"]
+            self._checked_at[company_id] = time.monotonic()
+            return engine
+
+    async def preload(self) -> None:
+        """Bản publish được attach khi có request đầu tiên, không cần nạp trước"""
+        return None
+
+    async def _publish_delta(self, company_id: str, version: int, images_data: List[Dict], removed_ids: List) -> Optional[Dict]:
+        mode = resolve_match_mode()
+
+        def collect(metadata: MetadataTable, next_id: int, descriptor_version: str):
+            # Engine tạm chỉ để gán id và tách descriptors của các ảnh mới
+            engine = ImageSearchEngine(company_id, mode, descriptor_version=descriptor_version)
+            engine.metadata = metadata
+            engine._next_id = next_id
+            vectors, row_ids = engine.collect_vectors(images_data)
+            return vectors, row_ids, engine._next_id
+
+        info = await asyncio.to_thread(shared_index.publish_delta, company_id, mode, version, removed_ids, collect)
+        # Worker này thấy ngay bản mới ở request kế tiếp
+        self._checked_at.pop(company_id, None)
+        return info
+
+    async def add_images(self, company_id, images_data: List[Dict]) -> None:
+        """Thêm ảnh mới vào bản index đã publish của company"""
+        company_id = str(company_id)
+        version = await self._bump_version(company_id)
+        if await self._publish_delta(company_id, version, images_data, []) is not None:
+            logger.info(f"Published {len(images_data)} new images to shared search index of company {company_id}")
+
+    async def remove_images(self, company_id, image_ids: List) -> None:
+        """Xóa ảnh khỏi bản index đã publish của company"""
+        company_id = str(company_id)
+        version = await self._bump_version(company_id)
+        if await self._publish_delta(company_id, version, [], image_ids) is not None:
+            logger.info(f"Removed {len(image_ids)} images from shared search index of company {company_id}")
+
+    def invalidate(self, company_id) -> None:
+        """Bỏ bản đang attach, lần search sau kiểm tra lại phiên bản đã publish"""
+        company_id = str(company_id)
+        self._engines.pop(company_id, None)
+        self._seqs.pop(company_id, None)
+        self._checked_at.pop(company_id, None)
+        logger.info(f"Invalidated search index for company {company_id}")
+
+
+def _create_registry() -> SearchIndexRegistry:
+    if shared_index.is_enabled():
+        if resolve_match_mode() == "bow":
+            logger.warning("Shared search index does not support bow mode, using per-worker indexes")
+        else:
+            return SharedSearchIndexRegistry()
+    return SearchIndexRegistry()
+
+
+# Registry dùng chung cho toàn bộ ứng dụng
+search_index_registry = _create_registry()
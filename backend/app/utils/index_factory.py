@@ -0,0 +1,135 @@
+import logging
+import math
+import os
+from typing import Optional, Tuple
+import numpy as np
+import faiss
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Loại index mặc định: "flat", "ivf", "hnsw" hoặc "auto" (chọn theo số lượng vector)
+SEARCH_INDEX_TYPE = os.getenv("SEARCH_INDEX_TYPE", "auto")
+# Ngưỡng số vector để chế độ auto chuyển sang IVF / HNSW
+SEARCH_IVF_MIN_VECTORS = int(os.getenv("SEARCH_IVF_MIN_VECTORS", "100000"))
+SEARCH_HNSW_MIN_VECTORS = int(os.getenv("SEARCH_HNSW_MIN_VECTORS", "5000000"))
+
+INDEX_TYPES = ("flat", "ivf", "hnsw")
+
+# Mức độ đánh đổi recall/latency cho mỗi request
+SEARCH_EFFORT_PRESETS = {
+    "fast": {"nprobe": 4, "ef_search": 32},
+    "balanced": {"nprobe": 16, "ef_search": 64},
+    "accurate": {"nprobe": 64, "ef_search": 256},
+}
+DEFAULT_SEARCH_EFFORT = "balanced"
+
+# efSearch cố định của HNSW, effort cao hơn được áp dụng bằng cách tìm nhiều láng giềng hơn
+HNSW_BASE_EF_SEARCH = 16
+HNSW_NEIGHBORS = 32
+# Số cụm tối thiểu để IVF có ý nghĩa, ít hơn thì dùng flat
+IVF_MIN_NLIST = 16
+
+
+def ivf_nlist(num_vectors: int) -> int:
+    """Số cụm IVF cho num_vectors vector: ~4 * sqrt(n), mỗi centroid cần ít nhất ~39 điểm để train"""
+    return min(65536, int(4 * math.sqrt(num_vectors)), num_vectors // 39)
+
+
+def choose_index_type(num_vectors: int, index_type: Optional[str] = None) -> str:
+    """Chọn loại index theo cấu hình, "auto" thì dựa trên số lượng vector"""
+    index_type = index_type or SEARCH_INDEX_TYPE
+    if index_type not in INDEX_TYPES:
+        if index_type != "auto":
+            logger.warning(f"Unknown index type {index_type}, using auto")
+        if num_vectors >= SEARCH_HNSW_MIN_VECTORS:
+            index_type = "hnsw"
+        elif num_vectors >= SEARCH_IVF_MIN_VECTORS:
+            index_type = "ivf"
+        else:
+            index_type = "flat"
+
+    if index_type == "ivf" and ivf_nlist(num_vectors) < IVF_MIN_NLIST:
+        # Không đủ dữ liệu để train IVF
+        return "flat"
+    return index_type
+
+
+class BinaryIndex:
+    """Bọc các loại FAISS binary index (flat, IVF, HNSW) sau cùng một giao diện dùng id của ảnh"""
+
+    def __init__(self, index, index_type: str):
+        self.index = index
+        self.index_type = index_type
+
+    @classmethod
+    def create(cls, dimension: int, index_type: str, training_vectors: Optional[np.ndarray] = None) -> "BinaryIndex":
+        if index_type == "ivf":
+            num_vectors = len(training_vectors) if training_vectors is not None else 0
+            nlist = ivf_nlist(num_vectors)
+            if nlist < IVF_MIN_NLIST:
+                # Không đủ dữ liệu để train IVF, dùng flat
+                logger.warning(f"Not enough vectors ({num_vectors}) to train IVF index, using flat")
+                return cls.create(dimension, "flat")
+            quantizer = faiss.IndexBinaryFlat(dimension)
+            index = faiss.IndexBinaryIVF(quantizer, dimension, nlist)
+            index.train(training_vectors)
+            # IVF tự hỗ trợ add_with_ids / remove_ids nên không cần IDMap
+            return cls(index, "ivf")
+
+        if index_type == "hnsw":
+            hnsw = faiss.IndexBinaryHNSW(dimension, HNSW_NEIGHBORS)
+            hnsw.hnsw.efSearch = HNSW_BASE_EF_SEARCH
+            return cls(faiss.IndexBinaryIDMap(hnsw), "hnsw")
+
+        return cls(faiss.IndexBinaryIDMap(faiss.IndexBinaryFlat(dimension)), "flat")
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def supports_remove(self) -> bool:
+        # HNSW không xóa được phần tử, ảnh bị xóa chỉ được bỏ qua khi đọc kết quả
+        return self.index_type != "hnsw"
+
+    def add_with_ids(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        self.index.add_with_ids(vectors, ids)
+
+    def remove_ids(self, ids: np.ndarray) -> int:
+        if not self.supports_remove:
+            return 0
+        return self.index.remove_ids(ids)
+
+    def search(self, vectors: np.ndarray, k: int, effort: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Tìm k láng giềng gần nhất, không thay đổi trạng thái của index nên an toàn khi chạy song song"""
+        preset = SEARCH_EFFORT_PRESETS.get(effort or DEFAULT_SEARCH_EFFORT, SEARCH_EFFORT_PRESETS[DEFAULT_SEARCH_EFFORT])
+        vectors = np.ascontiguousarray(vectors, dtype=np.uint8)
+
+        if self.index_type == "ivf":
+            nprobe = min(preset["nprobe"], self.index.nlist)
+            coarse_distances, assign = self.index.quantizer.search(vectors, nprobe)
+            n = len(vectors)
+            distances = np.empty((n, k), dtype=np.int32)
+            labels = np.empty((n, k), dtype=np.int64)
+            # Truyền nprobe qua tham số thay vì sửa index.nprobe (index dùng chung giữa các thread)
+            self.index.search_preassigned_c(
+                n, faiss.swig_ptr(vectors), k,
+                faiss.swig_ptr(assign), faiss.swig_ptr(coarse_distances),
+                faiss.swig_ptr(distances), faiss.swig_ptr(labels),
+                False, faiss.SearchParametersIVF(nprobe=nprobe)
+            )
+            return distances, labels
+
+        if self.index_type == "hnsw":
+            # HNSW dùng ef = max(efSearch, k): tăng k để tăng recall rồi cắt lại
+            distances, labels = self.index.search(vectors, max(k, preset["ef_search"]))
+            return distances[:, :k], labels[:, :k]
+
+        return self.index.search(vectors, k)
+
+    def copy(self) -> "BinaryIndex":
+        index = faiss.deserialize_index_binary(faiss.serialize_index_binary(self.index))
+        return BinaryIndex(index, self.index_type)
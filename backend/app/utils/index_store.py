@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+import re
+import shutil
+import uuid
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import faiss
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Thư mục lưu index đã build, mỗi company một thư mục con, mỗi phiên bản một thư mục v{version}
+SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR", "data/indexes")
+# Phiên bản (thư mục, thư mục tạm hoặc file theo định dạng cũ) được xóa khi có phiên bản mới hơn
+OLD_VERSION_PATTERN = re.compile(r"^(?:\.tmp-)?v(\d+)(?:[.-].*)?$")
+
+
+def _company_dir(company_id: str) -> str:
+    return os.path.join(SEARCH_INDEX_DIR, str(company_id))
+
+
+def _version_dir(company_id: str, version: int) -> str:
+    return os.path.join(_company_dir(company_id), f"v{version}")
+
+
+def _paths(directory: str) -> Tuple[str, str, str]:
+    """Đường dẫn file FAISS index, file mảng metadata ảnh và file thông tin trong thư mục của một phiên bản"""
+    return os.path.join(directory, "index"), os.path.join(directory, "arrays.npz"), os.path.join(directory, "meta.json")
+
+
+def list_company_ids() -> List[str]:
+    """Các company đã có index lưu trên đĩa"""
+    if not os.path.isdir(SEARCH_INDEX_DIR):
+        return []
+    return [
+        name for name in os.listdir(SEARCH_INDEX_DIR)
+        if os.path.isdir(os.path.join(SEARCH_INDEX_DIR, name))
+    ]
+
+
+def save_index(company_id: str, version: int, index, meta: Dict, arrays: Dict[str, np.ndarray]) -> None:
+    """Ghi index + metadata của một phiên bản, xóa các phiên bản cũ hơn"""
+    company_dir = _company_dir(company_id)
+    version_dir = _version_dir(company_id, version)
+    os.makedirs(company_dir, exist_ok=True)
+    if os.path.exists(version_dir):
+        return
+
+    # Ghi vào thư mục tạm riêng của process rồi đổi tên cả thư mục: worker khác không bao giờ
+    # đọc phải file ghi dở hay trộn file của hai worker cùng lưu một phiên bản
+    tmp_dir = os.path.join(company_dir, f".tmp-v{version}-{os.getpid()}-{uuid.uuid4().hex}")
+    os.makedirs(tmp_dir)
+    index_path, arrays_path, meta_path = _paths(tmp_dir)
+    try:
+        if index is not None:
+            faiss.write_index_binary(index, index_path)
+        with open(arrays_path, "wb") as f:
+            np.savez(f, **arrays)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({**meta, "version": version}, f)
+        os.rename(tmp_dir, version_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if os.path.exists(version_dir):
+            # Worker khác đã lưu phiên bản này trước
+            return
+        raise
+
+    for name in os.listdir(company_dir):
+        match = OLD_VERSION_PATTERN.match(name)
+        if match and int(match.group(1)) < version:
+            path = os.path.join(company_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+    logger.info(f"Saved search index of company {company_id} (version {version})")
+
+
+def load_index(company_id: str, version: int) -> Optional[Tuple[object, Dict, Dict[str, np.ndarray]]]:
+    """Đọc index của đúng phiên bản version, None nếu không có"""
+    index_path, arrays_path, meta_path = _paths(_version_dir(company_id, version))
+    # Bản lưu theo định dạng cũ (file v{version}.* ngay trong thư mục company) sẽ được build lại
+    if not os.path.exists(meta_path) or not os.path.exists(arrays_path):
+        return None
+
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+
+    # FAISS đọc index nhị phân vào bộ nhớ riêng của process (flat/HNSW không mmap được),
+    # muốn các worker dùng chung một bản thì bật SEARCH_SHARED_INDEX
+    index = faiss.read_index_binary(index_path) if os.path.exists(index_path) else None
+
+    with np.load(arrays_path) as data:
+        arrays = {name: data[name] for name in data.files}
+
+    return index, meta, arrays
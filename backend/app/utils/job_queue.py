@@ -0,0 +1,272 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from dotenv import load_dotenv
+from app.config.mongodb_config import jobs_collection
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Số worker xử lý job chạy trong mỗi process API (0 = chỉ chạy bằng run_job_worker.py)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Số lần thử tối đa trước khi đưa job vào dead-letter
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Thời gian chờ trước lần thử lại đầu tiên (giây), nhân đôi sau mỗi lần lỗi
+JOB_RETRY_BASE_DELAY = float(os.getenv("JOB_RETRY_BASE_DELAY", "10"))
+JOB_RETRY_MAX_DELAY = float(os.getenv("JOB_RETRY_MAX_DELAY", "3600"))
+# Thời gian một worker giữ job, quá hạn (worker bị tắt giữa chừng) job được worker khác nhận lại.
+# Job đang chạy được gia hạn mỗi JOB_LEASE_SECONDS / 3 giây
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+# Số giây chờ giữa hai lần kiểm tra khi hàng đợi trống
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+
+# Trạng thái của job
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_DEAD = "dead"  # Đã hết số lần thử, cần xử lý thủ công
+
+JobHandler = Callable[[Dict], Awaitable[Optional[Dict]]]
+
+
+def retry_delay(attempts: int) -> float:
+    """Thời gian chờ (giây) trước lần thử tiếp theo: exponential backoff có giới hạn"""
+    return min(JOB_RETRY_MAX_DELAY, JOB_RETRY_BASE_DELAY * (2 ** max(0, attempts - 1)))
+
+
+class JobQueue:
+    """Hàng đợi job bền vững lưu trong MongoDB (collection jobs).
+
+    Job được nhận bằng find_one_and_update nên nhiều worker (nhiều process) có thể chạy
+    song song mà không xử lý trùng. Mỗi lần nhận job tạo một lease_token mới, worker chỉ
+    gia hạn và cập nhật kết quả của job khi vẫn giữ token đó. Handler nên idempotent vì
+    job có thể chạy lại khi worker bị tắt giữa chừng hoặc khi thử lại sau lỗi.
+    """
+
+    def __init__(self):
+        self._handlers: Dict[str, JobHandler] = {}
+        self._tasks: List[asyncio.Task] = []
+        # Tạo trong start() để gắn với event loop đang chạy (Python 3.9 gắn Event với loop lúc khởi tạo)
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def register(self, job_type: str, handler: JobHandler) -> None:
+        self._handlers[job_type] = handler
+
+    async def ensure_indexes(self) -> None:
+        await jobs_collection.create_index([("status", ASCENDING), ("run_at", ASCENDING)])
+        await jobs_collection.create_index([("product_id", ASCENDING), ("created_at", ASCENDING)])
+        await jobs_collection.create_index([("batch_id", ASCENDING), ("status", ASCENDING)])
+
+    def _new_job(self, job_type: str, payload: Dict, product_id=None, company_id=None, batch_id=None,
+                 max_attempts: int = JOB_MAX_ATTEMPTS) -> Dict:
+        now = datetime.utcnow()
+        return {
+            "type": job_type,
+            "payload": payload,
+            "product_id": ObjectId(product_id) if product_id else None,
+            "company_id": ObjectId(company_id) if company_id else None,
+            "batch_id": ObjectId(batch_id) if batch_id else None,
+            "status": JOB_PENDING,
+            "attempts": 0,
+            "max_attempts": max_attempts,
+            "run_at": now,
+            "locked_until": None,
+            "lease_token": None,
+            "last_error": None,
+            "result": None,
+            "created_at": now,
+            "updated_at": now
+        }
+
+    async def enqueue(self, job_type: str, payload: Dict, product_id=None, company_id=None,
+                      max_attempts: int = JOB_MAX_ATTEMPTS) -> str:
+        """Thêm job vào hàng đợi, trả về id của job"""
+        job = self._new_job(job_type, payload, product_id, company_id, max_attempts=max_attempts)
+        result = await jobs_collection.insert_one(job)
+        self._notify()
+        logger.info(f"Enqueued {job_type} job {result.inserted_id}")
+        return str(result.inserted_id)
+
+    async def enqueue_many(self, job_type: str, payloads: List[Dict], company_id=None, batch_id=None) -> int:
+        """Thêm nhiều job cùng loại bằng một lệnh insert_many, gom theo batch_id để theo dõi chung"""
+        if not payloads:
+            return 0
+        jobs = [self._new_job(job_type, payload, company_id=company_id, batch_id=batch_id) for payload in payloads]
+        await jobs_collection.insert_many(jobs, ordered=False)
+        self._notify()
+        return len(jobs)
+
+    async def _claim(self) -> Optional[Dict]:
+        """Nhận một job đến hạn: job đang chờ, hoặc job đang chạy nhưng đã quá hạn giữ"""
+        now = datetime.utcnow()
+        return await jobs_collection.find_one_and_update(
+            {
+                "type": {"$in": list(self._handlers)},
+                "$or": [
+                    {"status": JOB_PENDING, "run_at": {"$lte": now}},
+                    {"status": JOB_RUNNING, "locked_until": {"$lt": now}}
+                ]
+            },
+            {
+                "$set": {
+                    "status": JOB_RUNNING,
+                    "locked_until": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                    "lease_token": ObjectId(),
+                    "updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _renew_lease(self, job: Dict) -> None:
+        """Gia hạn job trong lúc handler chạy, kết thúc khi job đã bị worker khác nhận lại"""
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            now = datetime.utcnow()
+            try:
+                result = await jobs_collection.update_one(
+                    {"_id": job["_id"], "lease_token": job["lease_token"]},
+                    {"$set": {"locked_until": now + timedelta(seconds=JOB_LEASE_SECONDS), "updated_at": now}}
+                )
+            except Exception as e:
+                logger.warning(f"Could not renew lease of job {job['_id']}: {str(e)}")
+                continue
+            if result.matched_count == 0:
+                return
+
+    async def _update_owned(self, job: Dict, update: Dict) -> None:
+        """Cập nhật job nếu worker này vẫn giữ lease (job quá hạn có thể đã được worker khác nhận)"""
+        result = await jobs_collection.update_one({"_id": job["_id"], "lease_token": job["lease_token"]}, update)
+        if result.matched_count == 0:
+            logger.warning(f"Job {job['_id']} ({job['type']}) was reclaimed by another worker, result discarded")
+
+    async def _finish(self, job: Dict, result: Optional[Dict]) -> None:
+        await self._update_owned(
+            job,
+            {"$set": {
+                "status": JOB_DONE,
+                "result": result,
+                "last_error": None,
+                "locked_until": None,
+                "updated_at": datetime.utcnow()
+            }}
+        )
+
+    async def _fail(self, job: Dict, error: str) -> None:
+        """Hẹn thử lại với backoff, hoặc chuyển sang dead-letter khi hết số lần thử"""
+        now = datetime.utcnow()
+        if job["attempts"] >= job.get("max_attempts", JOB_MAX_ATTEMPTS):
+            update = {"status": JOB_DEAD}
+            logger.error(f"Job {job['_id']} ({job['type']}) moved to dead-letter after {job['attempts']} attempts: {error}")
+        else:
+            delay = retry_delay(job["attempts"])
+            update = {"status": JOB_PENDING, "run_at": now + timedelta(seconds=delay)}
+            logger.warning(f"Job {job['_id']} ({job['type']}) failed, retrying in {delay:.0f}s: {error}")
+
+        await self._update_owned(
+            job,
+            {"$set": {**update, "last_error": error, "locked_until": None, "updated_at": now}}
+        )
+
+    async def run_once(self) -> bool:
+        """Nhận và xử lý một job, trả về False nếu không có job nào đến hạn"""
+        job = await self._claim()
+        if job is None:
+            return False
+
+        handler = asyncio.create_task(self._handlers[job["type"]](job))
+        heartbeat = asyncio.create_task(self._renew_lease(job))
+        try:
+            await asyncio.wait({handler, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Dừng handler nếu mất lease (worker khác đã nhận job) hoặc worker bị dừng
+            for task in (handler, heartbeat):
+                task.cancel()
+            await asyncio.gather(handler, heartbeat, return_exceptions=True)
+
+        if handler.cancelled():
+            logger.warning(f"Lost lease of job {job['_id']} ({job['type']}), stopped processing")
+            return True
+        if handler.exception() is not None:
+            error = handler.exception()
+            await self._fail(job, str(error) or type(error).__name__)
+        else:
+            await self._finish(job, handler.result())
+        return True
+
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            try:
+                if await self.run_once():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job worker {worker_id} error: {str(e)}")
+
+            # Hàng đợi trống: chờ job mới trong process này hoặc tới lần kiểm tra kế tiếp
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _notify(self) -> None:
+        """Đánh thức worker trong process này (nếu đã chạy) khi có job mới"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self, workers: int = JOB_WORKERS) -> None:
+        """Chạy các worker trong event loop hiện tại"""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        for worker_id in range(workers):
+            self._tasks.append(asyncio.create_task(self._worker(worker_id)))
+        if workers:
+            logger.info(f"Started {workers} job workers")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._wakeup = None
+
+    async def get_jobs(self, product_id, limit: int = 20) -> List[Dict]:
+        """Các job gần nhất của một sản phẩm"""
+        cursor = jobs_collection.find(
+            {"product_id": ObjectId(product_id)},
+            {"payload": 0}
+        ).sort("created_at", -1).limit(limit)
+        return await cursor.to_list(limit)
+
+
+    async def get_batch_status(self, batch_id) -> Dict:
+        """Số job theo từng trạng thái của một batch, kèm lỗi gần nhất"""
+        pipeline = [
+            {"$match": {"batch_id": ObjectId(batch_id)}},
+            {"$group": {
+                "_id": "$status",
+                "count": {"$sum": 1},
+                "last_error": {"$last": "$last_error"}
+            }}
+        ]
+        groups = await jobs_collection.aggregate(pipeline).to_list(None)
+        counts = {status: 0 for status in (JOB_PENDING, JOB_RUNNING, JOB_DONE, JOB_DEAD)}
+        errors = []
+        for group in groups:
+            counts[group["_id"]] = group["count"]
+            if group["_id"] == JOB_DEAD and group.get("last_error"):
+                errors.append(group["last_error"])
+        return {"counts": counts, "total": sum(counts.values()), "errors": errors}
+
+
+# Hàng đợi dùng chung cho toàn bộ ứng dụng
+job_queue = JobQueue()
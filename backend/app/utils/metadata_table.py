@@ -0,0 +1,161 @@
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+from bson import ObjectId
+
+# Các cột của bảng metadata (cũng là tên file khi lưu/publish)
+METADATA_FIELDS = ("faiss_ids", "image_ids", "product_ids", "created_at", "url_ids", "url_offsets", "url_data")
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _to_millis(value) -> int:
+    """datetime (naive = UTC như MongoDB trả về) -> mili giây từ epoch, -1 nếu không có"""
+    if not isinstance(value, datetime):
+        return -1
+    if value.tzinfo is not None:
+        return int(value.timestamp() * 1000)
+    return int((value - EPOCH) / timedelta(milliseconds=1))
+
+
+def _object_id_bytes(values: Iterable) -> np.ndarray:
+    """Danh sách ObjectId (hoặc string) -> mảng (n, 12) uint8"""
+    data = b"".join(ObjectId(value).binary for value in values)
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, 12)
+
+
+def _gather_segments(offsets: np.ndarray, data: np.ndarray, ids: np.ndarray):
+    """Lấy các đoạn bytes ids từ bảng (offsets, data), trả về (offsets, data) mới"""
+    starts = offsets[ids]
+    lengths = offsets[ids + 1] - starts
+    new_offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(lengths)
+    # Vị trí byte cần lấy = start của đoạn + vị trí trong đoạn
+    positions = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return new_offsets, data[positions]
+
+
+class MetadataTable:
+    """Metadata ảnh của index lưu dạng cột bằng NumPy thay vì giữ document MongoDB.
+
+    Mỗi dòng là một ảnh, sắp xếp theo faiss id tăng dần. URL được intern vào một bảng
+    bytes dùng chung, dict kết quả chỉ được tạo khi đọc (get). Các mảng không bao giờ
+    bị sửa tại chỗ nên copy() chỉ cần sao chép tham chiếu.
+    """
+
+    def __init__(self, company_id=None, arrays: Optional[Dict[str, np.ndarray]] = None):
+        self.company_id = ObjectId(company_id) if company_id else None
+        if arrays is None:
+            arrays = {
+                "faiss_ids": np.zeros(0, dtype=np.int64),
+                "image_ids": np.zeros((0, 12), dtype=np.uint8),
+                "product_ids": np.zeros((0, 12), dtype=np.uint8),
+                "created_at": np.zeros(0, dtype=np.int64),
+                "url_ids": np.zeros(0, dtype=np.int64),
+                "url_offsets": np.zeros(1, dtype=np.int64),
+                "url_data": np.zeros(0, dtype=np.uint8)
+            }
+        self.faiss_ids = arrays["faiss_ids"]  # Đã sắp xếp tăng dần
+        self.image_ids = arrays["image_ids"]  # (n, 12) bytes của ObjectId
+        self.product_ids = arrays["product_ids"]  # (n, 12) bytes của ObjectId
+        self.created_at = arrays["created_at"]  # Mili giây từ epoch, -1 nếu không có
+        self.url_ids = arrays["url_ids"]  # Vị trí URL của từng ảnh trong bảng URL
+        self.url_offsets = arrays["url_offsets"]  # Bảng URL: URL thứ i là url_data[offsets[i]:offsets[i + 1]]
+        self.url_data = arrays["url_data"]
+
+    def __len__(self) -> int:
+        return len(self.faiss_ids)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays().values())
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {name: getattr(self, name) for name in METADATA_FIELDS}
+
+    def copy(self) -> "MetadataTable":
+        return MetadataTable(self.company_id, self.arrays())
+
+    def _positions(self, image_ids: List) -> np.ndarray:
+        """Vị trí các dòng có _id thuộc image_ids"""
+        if not image_ids or not len(self):
+            return np.zeros(0, dtype=np.int64)
+        keys = _object_id_bytes(image_ids).view("S12").ravel()
+        return np.flatnonzero(np.isin(self.image_ids.view("S12").ravel(), keys))
+
+    def contains(self, image_ids: List) -> np.ndarray:
+        """Mảng bool: từng _id trong image_ids đã có trong bảng hay chưa"""
+        if not image_ids or not len(self):
+            return np.zeros(len(image_ids), dtype=bool)
+        keys = _object_id_bytes(image_ids).view("S12").ravel()
+        return np.isin(keys, self.image_ids.view("S12").ravel())
+
+    def append(self, faiss_ids: List[int], docs: List[Dict]) -> None:
+        """Thêm các ảnh mới (faiss id phải lớn hơn mọi id đã có)"""
+        if not docs:
+            return
+
+        # Intern URL: các ảnh trùng URL dùng chung một dòng trong bảng URL
+        interned: Dict[str, int] = {}
+        inverse = np.array([interned.setdefault(doc["image_url"], len(interned)) for doc in docs], dtype=np.int64)
+        encoded = [url.encode("utf-8") for url in interned]
+        lengths = np.array([len(url) for url in encoded], dtype=np.int64)
+        num_urls = len(self.url_offsets) - 1
+
+        created_at = np.array([_to_millis(doc.get("created_at")) for doc in docs], dtype=np.int64)
+
+        self.faiss_ids = np.concatenate([self.faiss_ids, np.asarray(faiss_ids, dtype=np.int64)])
+        self.image_ids = np.concatenate([self.image_ids, _object_id_bytes(doc["_id"] for doc in docs)])
+        self.product_ids = np.concatenate([self.product_ids, _object_id_bytes(doc["product_id"] for doc in docs)])
+        self.created_at = np.concatenate([self.created_at, created_at])
+        self.url_ids = np.concatenate([self.url_ids, inverse + num_urls])
+        self.url_offsets = np.concatenate([self.url_offsets, self.url_offsets[-1] + np.cumsum(lengths)])
+        self.url_data = np.concatenate([self.url_data, np.frombuffer(b"".join(encoded), dtype=np.uint8)])
+
+    def remove(self, image_ids: List) -> np.ndarray:
+        """Xóa các ảnh theo _id, trả về faiss id của các dòng đã xóa"""
+        positions = self._positions(image_ids)
+        if len(positions) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        removed = self.faiss_ids[positions]
+        keep = np.ones(len(self), dtype=bool)
+        keep[positions] = False
+        self.faiss_ids = self.faiss_ids[keep]
+        self.image_ids = self.image_ids[keep]
+        self.product_ids = self.product_ids[keep]
+        self.created_at = self.created_at[keep]
+
+        # Bỏ các URL không còn ảnh nào dùng
+        used_urls, url_ids = np.unique(self.url_ids[keep], return_inverse=True)
+        self.url_ids = url_ids.astype(np.int64).ravel()
+        self.url_offsets, self.url_data = _gather_segments(self.url_offsets, self.url_data, used_urls)
+        return removed
+
+    def positions_of(self, faiss_ids: np.ndarray) -> np.ndarray:
+        """Vị trí dòng của từng faiss id, -1 nếu không có (ảnh đã xóa)"""
+        faiss_ids = np.asarray(faiss_ids, dtype=np.int64)
+        positions = np.searchsorted(self.faiss_ids, faiss_ids)
+        found = positions < len(self.faiss_ids)
+        found[found] = self.faiss_ids[positions[found]] == faiss_ids[found]
+        return np.where(found, positions, -1)
+
+    def product_key(self, position: int) -> bytes:
+        """product_id (12 bytes) của dòng, dùng để gom kết quả theo sản phẩm mà không tạo dict"""
+        return self.product_ids[position].tobytes()
+
+    def row(self, position: int) -> Dict:
+        """Tạo dict metadata (cùng dạng document ảnh) của một dòng"""
+        url_id = int(self.url_ids[position])
+        created_at = int(self.created_at[position])
+        return {
+            "_id": ObjectId(self.image_ids[position].tobytes()),
+            "product_id": ObjectId(self.product_ids[position].tobytes()),
+            "company_id": self.company_id,
+            "image_url": self.url_data[self.url_offsets[url_id]:self.url_offsets[url_id + 1]].tobytes().decode("utf-8"),
+            "created_at": EPOCH + timedelta(milliseconds=created_at) if created_at >= 0 else None
+        }
+
+    def get(self, faiss_id: int, default=None) -> Optional[Dict]:
+        position = int(self.positions_of([faiss_id])[0])
+        return self.row(position) if position >= 0 else default
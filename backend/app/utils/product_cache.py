@@ -0,0 +1,89 @@
+import logging
+import os
+from typing import Dict, Iterable, Optional
+from bson import ObjectId
+from dotenv import load_dotenv
+from app.config.mongodb_config import products_collection
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Số sản phẩm tối đa giữ trong cache và thời gian sống (giây) của mỗi sản phẩm
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "10000"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "300"))
+
+# Các trường sản phẩm dùng trong kết quả tìm kiếm ảnh
+PRODUCT_SUMMARY_FIELDS = ("product_name", "product_code", "price", "brand", "description")
+
+
+class ProductCache:
+    """Cache document sản phẩm dùng chung cho tìm kiếm ảnh và xem/sửa sản phẩm.
+
+    Các route tạo/sửa/xóa sản phẩm phải gọi invalidate (hoặc put) sau khi ghi MongoDB.
+    Cache nằm trong từng process, khi chạy nhiều worker dữ liệu có thể cũ tối đa TTL giây.
+    Tìm kiếm ảnh chỉ đọc PRODUCT_SUMMARY_FIELDS và được cache riêng (get_summaries).
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache("products", maxsize, ttl)
+        self._summaries = TTLCache("product_summaries", maxsize, ttl)
+
+    async def get(self, product_id) -> Optional[dict]:
+        """Lấy một sản phẩm, None nếu không tồn tại"""
+        return (await self.get_many([product_id])).get(str(product_id))
+
+    async def get_many(self, product_ids: Iterable) -> Dict[str, dict]:
+        """Lấy nhiều sản phẩm, các sản phẩm chưa có trong cache được đọc bằng một truy vấn $in"""
+        products = {}
+        missing = []
+        for product_id in {str(product_id) for product_id in product_ids}:
+            product = self._cache.get(product_id)
+            if product is not None:
+                products[product_id] = dict(product)
+            else:
+                missing.append(ObjectId(product_id))
+
+        if missing:
+            async for product in products_collection.find({"_id": {"$in": missing}}):
+                self.put(product)
+                products[str(product["_id"])] = dict(product)
+        return products
+
+    async def get_summaries(self, product_ids: Iterable) -> Dict[str, dict]:
+        """Lấy các trường hiển thị trong kết quả tìm kiếm, phần chưa có trong cache đọc bằng một truy vấn $in có projection"""
+        products = {}
+        missing = []
+        for product_id in {str(product_id) for product_id in product_ids}:
+            product = self._cache.get(product_id) or self._summaries.get(product_id)
+            if product is not None:
+                products[product_id] = dict(product)
+            else:
+                missing.append(ObjectId(product_id))
+
+        if missing:
+            projection = {field: 1 for field in PRODUCT_SUMMARY_FIELDS}
+            async for product in products_collection.find({"_id": {"$in": missing}}, projection):
+                self._summaries.set(str(product["_id"]), dict(product))
+                products[str(product["_id"])] = dict(product)
+        return products
+
+    def put(self, product: dict) -> None:
+        """Lưu (bản sao của) document sản phẩm vừa đọc/ghi vào cache"""
+        self._cache.set(str(product["_id"]), dict(product))
+        self._summaries.pop(str(product["_id"]))
+
+    def invalidate(self, product_id) -> None:
+        self._cache.pop(str(product_id))
+        self._summaries.pop(str(product_id))
+
+    def stats(self) -> Dict:
+        return self._cache.stats()
+
+    def summary_stats(self) -> Dict:
+        return self._summaries.stats()
+
+
+# Cache dùng chung cho toàn bộ ứng dụng
+product_cache = ProductCache(PRODUCT_CACHE_SIZE, PRODUCT_CACHE_TTL)
@@ -0,0 +1,100 @@
+import logging
+import os
+from typing import Dict, List, Optional
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+from app.utils.cache import TTLCache
+from app.utils.image_hash_cache import content_digest
+from app.utils.search_pool import search_pool
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Số kết quả tìm kiếm giữ trong cache và thời gian sống (giây)
+SEARCH_RESULT_CACHE_SIZE = int(os.getenv("SEARCH_RESULT_CACHE_SIZE", "1000"))
+SEARCH_RESULT_CACHE_TTL = float(os.getenv("SEARCH_RESULT_CACHE_TTL", "600"))
+# Dùng thêm perceptual hash (dHash 64-bit) để nhận ra ảnh gần giống (gửi lại qua chat, nén lại).
+# Tắt mặc định vì ảnh sản phẩm khác nhau nhưng cùng bố cục có thể trùng dHash
+SEARCH_RESULT_CACHE_PERCEPTUAL = os.getenv("SEARCH_RESULT_CACHE_PERCEPTUAL", "0") == "1"
+
+
+def perceptual_hash(image_bytes: bytes) -> Optional[str]:
+    """dHash 64-bit (hex) của ảnh, giải mã ở 1/8 độ phân giải nên rẻ hơn nhiều so với tính ORB"""
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if img is None:
+        return None
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1]).tobytes().hex()
+
+
+class QueryResultCache:
+    """Cache kết quả tìm kiếm (chưa gắn thông tin sản phẩm) theo nội dung ảnh truy vấn.
+
+    Key gồm company, search_index_version của index đã dùng, top_k và effort nên kết quả
+    tự hết hiệu lực khi ảnh của company thay đổi.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, perceptual: bool):
+        self._cache = TTLCache("search_results", maxsize, ttl)
+        self.perceptual = perceptual
+
+    def _lookup(self, base: tuple, keys: List[tuple]) -> Optional[List[Dict]]:
+        for key in keys:
+            results = self._cache.get(base + key)
+            if results is not None:
+                return results
+        return None
+
+    async def search(self, engine, company_id, images: List[bytes], top_k: int,
+                     effort: Optional[str]) -> List[Optional[List[Dict]]]:
+        """Tìm kiếm nhiều ảnh, chỉ tính ORB + FAISS cho ảnh chưa có trong cache.
+
+        Trả về kết quả theo thứ tự ảnh, None cho ảnh không tính được đặc trưng.
+        """
+        results: List[Optional[List[Dict]]] = [None] * len(images)
+        cacheable = engine.version is not None and self._cache.maxsize > 0
+        base = (str(company_id), engine.version, top_k, effort)
+        keys = [[("sha256", content_digest(image))] if cacheable else [] for image in images]
+
+        misses = []
+        for i, image_keys in enumerate(keys):
+            cached = self._lookup(base, image_keys)
+            if cached is not None:
+                results[i] = cached
+            else:
+                misses.append(i)
+
+        if cacheable and self.perceptual and misses:
+            phashes = await search_pool.map(perceptual_hash, [images[i] for i in misses])
+            remaining = []
+            for i, phash in zip(misses, phashes):
+                cached = None
+                if phash is not None:
+                    keys[i].append(("dhash", phash))
+                    cached = self._lookup(base, keys[i][-1:])
+                if cached is not None:
+                    results[i] = cached
+                else:
+                    remaining.append(i)
+            misses = remaining
+
+        if misses:
+            # Tính ORB song song rồi search cả lô bằng một lần gọi FAISS
+            queries = await search_pool.map(engine.calculate_orb_from_bytes, [images[i] for i in misses])
+            searched = await search_pool.run(engine.search_descriptors, queries, top_k, effort)
+            for i, query, query_results in zip(misses, queries, searched):
+                if query is None:
+                    continue
+                results[i] = query_results
+                for key in keys[i]:
+                    self._cache.set(base + key, query_results)
+        return results
+
+    def stats(self) -> Dict:
+        return self._cache.stats()
+
+
+# Cache dùng chung cho toàn bộ ứng dụng
+query_result_cache = QueryResultCache(SEARCH_RESULT_CACHE_SIZE, SEARCH_RESULT_CACHE_TTL, SEARCH_RESULT_CACHE_PERCEPTUAL)
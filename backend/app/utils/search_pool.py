@@ -0,0 +1,65 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Số thread xử lý tìm kiếm (ORB + FAISS đều nhả GIL nên dùng thread là đủ)
+SEARCH_POOL_WORKERS = int(os.getenv("SEARCH_POOL_WORKERS", "4"))
+# Số tác vụ (ảnh) được phép chờ thêm khi tất cả thread đang bận
+SEARCH_POOL_QUEUE_SIZE = int(os.getenv("SEARCH_POOL_QUEUE_SIZE", "16"))
+# Số ảnh tối đa trong một request tìm kiếm hàng loạt
+SEARCH_BATCH_MAX_IMAGES = int(os.getenv("SEARCH_BATCH_MAX_IMAGES", "20"))
+
+
+class SearchPoolSaturated(Exception):
+    """Pool tìm kiếm đã đầy, request nên được trả về 429"""
+
+
+class SearchWorkerPool:
+    """Chạy các tác vụ CPU của tìm kiếm ảnh ngoài event loop, có giới hạn hàng đợi"""
+
+    def __init__(self, max_workers: int, queue_size: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-search")
+        self._capacity = max_workers + queue_size
+        self._pending = 0  # Chỉ thay đổi trong event loop nên không cần lock
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _admit(self, slots: int = 1) -> None:
+        # Pool đang rảnh thì luôn nhận, để lô lớn hơn sức chứa không bị từ chối mãi
+        if self._pending and self._pending + slots > self._capacity:
+            logger.warning(f"Search pool saturated ({self._pending}/{self._capacity} pending tasks)")
+            raise SearchPoolSaturated()
+
+    async def run(self, fn, *args, **kwargs):
+        """Chạy fn trong pool, raise SearchPoolSaturated nếu đã quá tải"""
+        self._admit()
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+    async def map(self, fn, items):
+        """Chạy fn song song cho từng phần tử trong pool, mỗi phần tử chiếm một chỗ khi kiểm tra quá tải"""
+        items = list(items)
+        self._admit(len(items))
+        self._pending += len(items)
+        try:
+            loop = asyncio.get_running_loop()
+            return await asyncio.gather(*(loop.run_in_executor(self._executor, fn, item) for item in items))
+        finally:
+            self._pending -= len(items)
+
+
+# Pool dùng chung cho toàn bộ ứng dụng
+search_pool = SearchWorkerPool(SEARCH_POOL_WORKERS, SEARCH_POOL_QUEUE_SIZE)
@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import faiss
+from dotenv import load_dotenv
+from app.features import LEGACY_DESCRIPTOR_VERSION
+from app.utils.metadata_table import MetadataTable, METADATA_FIELDS
+
+try:
+    import fcntl
+except ImportError:  # Windows không có fcntl, chế độ chia sẻ index không dùng được
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Bật chế độ chia sẻ index giữa các worker (uvicorn/gunicorn --workers N)
+SEARCH_SHARED_INDEX = os.getenv("SEARCH_SHARED_INDEX", "false").lower() in ("1", "true", "yes")
+# Thư mục chứa index dùng chung, đặt trong /dev/shm để nằm hoàn toàn trong RAM
+SEARCH_SHARED_DIR = os.getenv("SEARCH_SHARED_DIR", "data/shared")
+# Số giây giữa hai lần worker kiểm tra index dùng chung có phiên bản mới
+SEARCH_SHARED_REFRESH_INTERVAL = float(os.getenv("SEARCH_SHARED_REFRESH_INTERVAL", "2"))
+
+def is_enabled() -> bool:
+    if SEARCH_SHARED_INDEX and fcntl is None:
+        logger.warning("Shared search index requires fcntl (Linux/macOS), using per-worker indexes")
+        return False
+    return SEARCH_SHARED_INDEX
+
+
+class SharedCodesIndex:
+    """Tìm kiếm Hamming brute-force trực tiếp trên ma trận codes được mmap (không sao chép vào worker)"""
+
+    index_type = "shared"
+    supports_remove = False
+
+    def __init__(self, codes: np.ndarray, row_ids: np.ndarray):
+        self.codes = codes  # (số dòng, số byte) uint8, mmap read-only
+        self.row_ids = row_ids  # id ảnh của từng dòng
+
+    @property
+    def ntotal(self) -> int:
+        return len(self.codes)
+
+    def search(self, vectors: np.ndarray, k: int, effort: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        distances, rows = faiss.knn_hamming(np.ascontiguousarray(vectors, dtype=np.uint8), self.codes, k)
+        labels = np.where(rows >= 0, self.row_ids[np.maximum(rows, 0)], -1)
+        return distances, labels
+
+
+def _company_dir(company_id: str) -> str:
+    return os.path.join(SEARCH_SHARED_DIR, str(company_id))
+
+
+def acquire_lock(company_id: str):
+    """Chờ và giữ khóa file của company (chỉ một process build/publish index tại một thời điểm)"""
+    os.makedirs(_company_dir(company_id), exist_ok=True)
+    lock_file = open(os.path.join(_company_dir(company_id), ".lock"), "a+")
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    return lock_file
+
+
+def release_lock(lock_file) -> None:
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    finally:
+        lock_file.close()
+
+
+@contextmanager
+def company_lock(company_id: str):
+    lock_file = acquire_lock(company_id)
+    try:
+        yield
+    finally:
+        release_lock(lock_file)
+
+
+def read_current(company_id: str) -> Optional[Dict]:
+    """Thông tin phiên bản đang được publish của company (seq, data_version, mode, next_id, descriptor_version)"""
+    try:
+        with open(os.path.join(_company_dir(company_id), "current.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def attach(company_id: str, info: Dict) -> Tuple[SharedCodesIndex, MetadataTable]:
+    """Mở (mmap read-only) index đã publish theo thông tin trong current.json"""
+    path = os.path.join(_company_dir(company_id), f"s{info['seq']}")
+    codes = np.load(os.path.join(path, "codes.npy"), mmap_mode="r")
+    row_ids = np.load(os.path.join(path, "row_ids.npy"), mmap_mode="r")
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in METADATA_FIELDS}
+    return SharedCodesIndex(codes, row_ids), MetadataTable(company_id, arrays)
+
+
+def publish(company_id: str, codes: np.ndarray, row_ids: np.ndarray, arrays: Dict[str, np.ndarray],
+            data_version: int, mode: str, next_id: int, descriptor_version: str) -> Dict:
+    """Ghi một phiên bản index mới rồi chuyển current.json sang nó (gọi khi đang giữ khóa của company)"""
+    current = read_current(company_id)
+    seq = current["seq"] + 1 if current else 1
+    company_dir = _company_dir(company_id)
+
+    # Ghi vào thư mục tạm rồi đổi tên, worker khác chỉ thấy phiên bản đã ghi xong
+    tmp_path = os.path.join(company_dir, f".tmp-s{seq}-{os.getpid()}")
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, "codes.npy"), codes)
+    np.save(os.path.join(tmp_path, "row_ids.npy"), row_ids)
+    for name in METADATA_FIELDS:
+        np.save(os.path.join(tmp_path, f"{name}.npy"), arrays[name])
+    os.rename(tmp_path, os.path.join(company_dir, f"s{seq}"))
+
+    info = {
+        "seq": seq, "data_version": data_version, "mode": mode, "next_id": next_id,
+        "descriptor_version": descriptor_version
+    }
+    with open(os.path.join(company_dir, "current.json.tmp"), "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    os.replace(os.path.join(company_dir, "current.json.tmp"), os.path.join(company_dir, "current.json"))
+
+    # Xóa các phiên bản cũ: worker đang mmap vẫn đọc được cho tới khi đóng file
+    for name in os.listdir(company_dir):
+        if name.startswith("s") and name[1:].isdigit() and int(name[1:]) < seq:
+            shutil.rmtree(os.path.join(company_dir, name), ignore_errors=True)
+
+    logger.info(f"Published shared search index of company {company_id} (seq {seq}, version {data_version})")
+    return info
+
+
+def publish_delta(company_id: str, mode: str, version: int, removed_image_ids: List,
+                  collect: Callable[[MetadataTable, int, str], Tuple[Optional[np.ndarray], Optional[np.ndarray], int]]) -> Optional[Dict]:
+    """Tạo phiên bản mới từ phiên bản đang publish: bỏ các ảnh bị xóa, thêm ảnh mới.
+
+    collect(metadata, next_id, descriptor_version) thêm ảnh mới vào metadata, trả về (vectors, row_ids, next_id mới).
+    Trả về None nếu chưa có phiên bản nào được publish (lần đọc sau sẽ build từ MongoDB).
+    """
+    with company_lock(company_id):
+        current = read_current(company_id)
+        if current is None or current["mode"] != mode:
+            return None
+
+        codes_index, metadata = attach(company_id, current)
+        # Các mảng mới được tạo trong bộ nhớ, file đang mmap không bị sửa
+        removed = metadata.remove(removed_image_ids)
+        keep = ~np.isin(codes_index.row_ids, removed)
+        codes = codes_index.codes[keep]
+        row_ids = codes_index.row_ids[keep]
+
+        descriptor_version = current.get("descriptor_version", LEGACY_DESCRIPTOR_VERSION)
+        vectors, new_row_ids, next_id = collect(metadata, current["next_id"], descriptor_version)
+        if vectors is not None:
+            codes = np.vstack([codes, vectors])
+            row_ids = np.concatenate([row_ids, new_row_ids])
+
+        # Chỉ tiến data_version khi thay đổi nối tiếp trực tiếp phiên bản đang publish;
+        # nếu có thay đổi khác xen giữa, giữ nguyên để worker đọc thấy cũ và build lại từ MongoDB
+        data_version = version if version == current["data_version"] + 1 else current["data_version"]
+        return publish(company_id, codes, row_ids, metadata.arrays(), data_version, mode, next_id, descriptor_version)
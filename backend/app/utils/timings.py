@@ -0,0 +1,42 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+
+class StageTimings:
+    """Thống kê thời gian từng bước xử lý (giải mã, resize, ORB, search), cộng dồn từ nhiều thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, list] = {}  # tên bước -> [số lần, tổng thời gian, lâu nhất]
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            stat = self._stages.setdefault(stage, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+
+    @contextmanager
+    def measure(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                stage: {
+                    "count": count,
+                    "avg_ms": round(total / count * 1000, 3),
+                    "max_ms": round(longest * 1000, 3)
+                }
+                for stage, (count, total, longest) in self._stages.items()
+            }
+
+
+# Thời gian xử lý ảnh truy vấn của API tìm kiếm
+query_timings = StageTimings()
@@ -0,0 +1,49 @@
+import logging
+import os
+from typing import Dict, Optional
+from bson import ObjectId
+from dotenv import load_dotenv
+from app.config.mongodb_config import users_collection
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Số user tối đa giữ trong cache và thời gian sống (giây), để ngắn vì role/status có thể đổi
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+
+# Không bao giờ giữ mật khẩu trong cache
+USER_PROFILE_PROJECTION = {"password_hash": 0}
+
+
+class UserCache:
+    """Cache thông tin user (company_id, role, username, ...) theo _id cho các request đã xác thực.
+
+    Các route sửa/xóa user phải gọi invalidate sau khi ghi MongoDB.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache("users", maxsize, ttl)
+
+    async def get(self, user_id) -> Optional[dict]:
+        """Lấy thông tin user (không có password_hash), None nếu không tồn tại"""
+        user_id = str(user_id)
+        user = self._cache.get(user_id)
+        if user is None:
+            user = await users_collection.find_one({"_id": ObjectId(user_id)}, USER_PROFILE_PROJECTION)
+            if user is None:
+                return None
+            self._cache.set(user_id, user)
+        return dict(user)
+
+    def invalidate(self, user_id) -> None:
+        self._cache.pop(str(user_id))
+
+    def stats(self) -> Dict:
+        return self._cache.stats()
+
+
+# Cache dùng chung cho toàn bộ ứng dụng
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
@@ -0,0 +1,65 @@
+import argparse
+import logging
+import time
+import cv2
+import numpy as np
+from app.features import CURRENT_SPEC, decode_image, extract_descriptors, get_orb_detector
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def make_images(count: int, width: int, height: int):
+    """Sinh ảnh JPEG ngẫu nhiên (có khối màu để ORB tìm được keypoints)"""
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(count):
+        img = cv2.GaussianBlur((rng.random((height, width, 3)) * 255).astype(np.uint8), (5, 5), 0)
+        for _ in range(20):
+            x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+            color = tuple(int(c) for c in rng.integers(0, 255, 3))
+            cv2.rectangle(img, (x, y), (x + width // 10, y + height // 10), color, -1)
+        images.append(cv2.imencode(".jpg", img)[1].tobytes())
+    return images
+
+
+def benchmark(name: str, fn, items, rounds: int) -> float:
+    """Thời gian trung bình (ms) mỗi ảnh"""
+    for item in items:
+        fn(item)  # Làm nóng
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for item in items:
+            fn(item)
+    per_image = (time.perf_counter() - started) / (rounds * len(items)) * 1000
+    logger.info(f"{name:<40} {per_image:8.3f} ms/ảnh")
+    return per_image
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo chi phí tạo ORB detector mỗi lần gọi so với dùng lại detector của thread")
+    parser.add_argument("--images", type=int, default=20, help="Số ảnh thử")
+    parser.add_argument("--width", type=int, default=1024, help="Chiều rộng ảnh")
+    parser.add_argument("--height", type=int, default=768, help="Chiều cao ảnh")
+    parser.add_argument("--rounds", type=int, default=10, help="Số vòng đo")
+    args = parser.parse_args()
+
+    images = make_images(args.images, args.width, args.height)
+    decoded = [decode_image(image, CURRENT_SPEC) for image in images]
+
+    # Chỉ bước ORB (ảnh đã giải mã): chênh lệch chính là chi phí cv2.ORB_create
+    create_per_call = benchmark(
+        "ORB_create mỗi ảnh (chỉ ORB)",
+        lambda img: cv2.ORB_create(nfeatures=CURRENT_SPEC.num_features).detectAndCompute(img, None), decoded, args.rounds
+    )
+    cached = benchmark(
+        "Detector của thread (chỉ ORB)",
+        lambda img: get_orb_detector(CURRENT_SPEC.num_features).detectAndCompute(img, None), decoded, args.rounds
+    )
+    benchmark("extract_descriptors (giải mã + ORB)", lambda image: extract_descriptors(image, CURRENT_SPEC), images, args.rounds)
+    logger.info(f"Tiết kiệm {create_per_call - cached:.3f} ms/ảnh ({(1 - cached / create_per_call) * 100:.1f}% bước ORB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import argparse
+import asyncio
+import logging
+from app.utils.job_queue import job_queue, JOB_WORKERS
+from app.utils.image_processing import close_http_client
+from app.utils.image_jobs import ensure_image_indexes  # Đăng ký handler cho các job xử lý ảnh
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Chạy worker xử lý hàng đợi job (tính hash ảnh) tách khỏi API")
+    parser.add_argument("--workers", type=int, default=max(JOB_WORKERS, 1), help="Số job xử lý đồng thời")
+    args = parser.parse_args()
+
+    await job_queue.ensure_indexes()
+    try:
+        await ensure_image_indexes()
+    except Exception as e:
+        logger.error(f"Error creating image indexes: {str(e)}")
+    job_queue.start(args.workers)
+    try:
+        # Chạy cho tới khi bị dừng (Ctrl+C / SIGTERM)
+        await asyncio.Event().wait()
+    finally:
+        await job_queue.stop()
+        await close_http_client()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Job worker stopped")
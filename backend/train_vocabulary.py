@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import logging
+import time
+import numpy as np
+from bson import ObjectId
+from app.config.mongodb_config import images_collection
+from app.utils.bow_index import BinaryVocabulary, VOCABULARY_PATH
+from app.features import DESCRIPTOR_SPECS, FEATURE_VERSION, LEGACY_DESCRIPTOR_VERSION, get_spec, image_hash_for
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+async def load_image_descriptors(max_images: int, company_id: str = None, version: str = FEATURE_VERSION):
+    """Lấy mẫu ngẫu nhiên descriptors (bỏ padding) theo một descriptor version của các ảnh trong MongoDB"""
+    spec = get_spec(version)
+    # Ảnh có image_hash theo version (ảnh cũ không có descriptor_version là orb32-v1)
+    # hoặc next_image_hash đã tính trước cho version đó
+    current = {"image_hash": {"$ne": None}, "descriptor_version": version}
+    if version == LEGACY_DESCRIPTOR_VERSION:
+        current["descriptor_version"] = {"$in": [version, None]}
+    match = {"$or": [current, {"next_image_hash": {"$ne": None}, "next_descriptor_version": version}]}
+    if company_id:
+        match["company_id"] = ObjectId(company_id)
+
+    pipeline = [
+        {"$match": match},
+        {"$sample": {"size": max_images}},
+        {"$project": {"image_hash": 1, "descriptor_version": 1, "next_image_hash": 1, "next_descriptor_version": 1}}
+    ]
+
+    image_descriptors = []
+    async for image in images_collection.aggregate(pipeline):
+        image_hash = image_hash_for(image, version)
+        if image_hash is None:
+            continue
+        try:
+            descriptors = np.frombuffer(image_hash, dtype=np.uint8).reshape(spec.num_features, spec.descriptor_size)
+        except Exception as e:
+            logger.warning(f"Bỏ qua ảnh {image['_id']}: image_hash không hợp lệ ({str(e)})")
+            continue
+        descriptors = descriptors[np.any(descriptors != 0, axis=1)]
+        if len(descriptors):
+            image_descriptors.append(descriptors)
+
+    return image_descriptors
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Train vocabulary ORB cho chế độ tìm kiếm bag-of-words")
+    parser.add_argument("--max-images", type=int, default=50000, help="Số ảnh lấy mẫu để train")
+    parser.add_argument("--branching", type=int, default=10, help="Số nhánh mỗi node của cây")
+    parser.add_argument("--depth", type=int, default=4, help="Độ sâu của cây (số word tối đa = branching^depth)")
+    parser.add_argument("--iterations", type=int, default=10, help="Số vòng lặp k-majority mỗi node")
+    parser.add_argument("--company-id", default=None, help="Chỉ lấy ảnh của một công ty")
+    parser.add_argument("--descriptor-version", default=FEATURE_VERSION, choices=sorted(DESCRIPTOR_SPECS),
+                        help="Chỉ lấy descriptors theo version này (mặc định FEATURE_VERSION)")
+    parser.add_argument("--output", default=VOCABULARY_PATH, help="Đường dẫn file vocabulary")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    image_descriptors = await load_image_descriptors(args.max_images, args.company_id, args.descriptor_version)
+    if not image_descriptors:
+        logger.error(f"Không có ảnh nào có descriptors {args.descriptor_version} để train vocabulary")
+        return
+    logger.info(f"Đã tải descriptors {args.descriptor_version} của {len(image_descriptors)} ảnh")
+
+    vocabulary = BinaryVocabulary.train(
+        image_descriptors,
+        branching=args.branching,
+        depth=args.depth,
+        iterations=args.iterations
+    )
+    vocabulary.save(args.output)
+
+    logger.info(f"Đã lưu vocabulary ({vocabulary.num_words} words) vào {args.output} "
+                f"trong {time.time() - start_time:.2f} giây")
+    logger.info("Khởi động lại backend để các index bag-of-words dùng vocabulary mới")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())